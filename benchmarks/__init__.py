@@ -0,0 +1,28 @@
+'''
+Rough benchmarks for RepriseDB.  Run them from the project root e.g.
+
+    python -m benchmarks.proxy_merge
+'''
+
+from contextlib import contextmanager
+import shutil
+import tempfile
+import time
+
+@contextmanager
+def tempdir():
+    path = tempfile.mkdtemp(prefix='reprisedb-bench-')
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path)
+
+def timed(f, *args, **kwargs):
+    ' returns (elapsed seconds, result) '
+    start = time.time()
+    result = f(*args, **kwargs)
+    return time.time() - start, result
+
+def report(name, count, elapsed, unit='rows'):
+    rate = count / elapsed if elapsed else 0
+    print "%-45s %10d %s %8.3fs %12.0f %s/s" % (name, count, unit, elapsed, rate, unit)
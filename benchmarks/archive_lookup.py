@@ -0,0 +1,52 @@
+'''
+Point reads against a ProxyDataStore of daily ArchiveDataStores, each holding the
+keys changed on that day.
+'''
+
+import random
+
+from reprisedb import drivers, datastore
+
+from benchmarks import tempdir, timed, report
+
+DAYS = 365
+KEYS_PER_DAY = 200
+LOOKUPS = 5000
+
+def build_stack(path):
+    driver = drivers.LMDBDriver(path, max_dbs=DAYS + 1)
+    
+    stack = []
+    for day in range(DAYS):
+        ds = datastore.ArchiveDataStore(driver.get_db('day-%d' % day), '%s/day-%d' % (path, day), 0)
+        ds.store(( ('%08d\x00' % k, 'value-%d' % k) for k in xrange(day * KEYS_PER_DAY, (day + 1) * KEYS_PER_DAY) ), day + 1)
+        stack.insert(0, ds)
+        
+    return datastore.ProxyDataStore(stack)
+
+def lookups(ds, keys):
+    for k in keys:
+        ds.get_item(k)
+    return len(keys)
+
+def layers_touched(ds, keys):
+    touched = 0
+    for k in keys:
+        for layer in ds.datastores:
+            if layer.might_contain(k):
+                touched += 1
+    return touched
+
+if __name__ == '__main__':
+    with tempdir() as path:
+        ds = build_stack(path)
+        keys = [ '%08d\x00' % random.randrange(DAYS * KEYS_PER_DAY) for _i in xrange(LOOKUPS) ]
+        
+        elapsed, count = timed(lookups, ds, keys)
+        report("get_item over %d archives" % DAYS, count, elapsed, 'reads')
+        print "average layers touched per read: %.2f" % (layers_touched(ds, keys) / float(LOOKUPS))
+        
+        for layer in ds.datastores:
+            layer.bloom = None
+        elapsed, count = timed(lookups, ds, keys[:LOOKUPS // 10])
+        report("get_item over %d archives (no bloom)" % DAYS, count, elapsed, 'reads')
@@ -0,0 +1,91 @@
+'''
+Many concurrent clients driving one AsyncRepriseDB.  Each client is a chain of
+callbacks, as it would be in an event driven server, doing a run of reads and
+a short scan then committing an update.
+'''
+
+import random
+import threading
+
+from reprisedb import database, asyncdb
+
+from benchmarks import tempdir, timed, report
+
+DOCUMENTS = 10000
+CLIENTS = 1000
+READS = 20
+
+def load(db):
+    t = db.begin()
+    t.create_collection('people')
+    t.bulk_put('people', ( (x, {'name': 'Person %d' % x}) for x in xrange(DOCUMENTS) ))
+    t.commit()
+
+class Client(object):
+
+    def __init__(self, adb, n, finished):
+        self.adb = adb
+        self.n = n
+        self.finished = finished
+        self.reads = 0
+
+    def start(self):
+        self.adb.begin().add_done_callback(self.begun)
+
+    def begun(self, f):
+        self.t = f.result()
+        self.read()
+
+    def read(self, f=None):
+        if f is not None: f.result()
+
+        if self.reads == READS:
+            start = random.randrange(DOCUMENTS - 50)
+            self.scan = self.t.keys('people', start, start + 50, chunk_size=25)
+            self.scan.next_chunk().add_done_callback(self.scanned)
+            return
+
+        self.reads += 1
+        self.t.get('people', random.randrange(DOCUMENTS)).add_done_callback(self.read)
+
+    def scanned(self, f):
+        if f.result():
+            self.scan.next_chunk().add_done_callback(self.scanned)
+        else:
+            self.t.put('people', self.n, {'name': 'Client %d' % self.n}).add_done_callback(self.put)
+
+    def put(self, f):
+        f.result()
+        self.t.commit().add_done_callback(self.committed)
+
+    def committed(self, f):
+        f.result()
+        self.finished()
+
+def run(db, workers):
+    adb = asyncdb.AsyncRepriseDB(db, workers=workers)
+    done = threading.Event()
+    remaining = [CLIENTS]
+    lock = threading.Lock()
+
+    def finished():
+        with lock:
+            remaining[0] -= 1
+            if not remaining[0]: done.set()
+
+    for n in xrange(CLIENTS):
+        Client(adb, n, finished).start()
+
+    done.wait()
+    adb.close()
+
+    return CLIENTS * (READS + 4)
+
+if __name__ == '__main__':
+    with tempdir() as path:
+        db = database.RepriseDB(path=path)
+        load(db)
+
+        for workers in (1, 4, 8, 16):
+            elapsed, count = timed(run, db, workers)
+            report("%d clients, %d workers" % (CLIENTS, workers), count, elapsed, 'ops')
@@ -0,0 +1,30 @@
+'''
+Nightly compaction: archive every revision of a RevisionDataStore then prune it
+to three revisions per key.
+'''
+
+import os
+
+from reprisedb import drivers, datastore
+
+from benchmarks import tempdir, timed, report
+
+KEYS = 20000
+REVISIONS = 5
+
+def build_source(driver):
+    source = datastore.RevisionDataStore(driver.get_db('source'), 0)
+    for r in range(1, REVISIONS + 1):
+        source.store(( ('%08d\x00' % k, os.urandom(16).encode('hex') * 8) for k in xrange(KEYS) ), r)
+    return source
+
+if __name__ == '__main__':
+    for processes in (None, 2, 4):
+        with tempdir() as path:
+            driver = drivers.LMDBDriver(path)
+            source = build_source(driver)
+            archive = datastore.ArchiveDataStore(driver.get_db('archive'), path + '/archive', 0)
+            
+            elapsed, _pruned = timed(datastore.compact, source, archive, 3, processes)
+            report("compact with %s processes" % (processes or 'no'), KEYS * REVISIONS, elapsed)
+            archive.close()
@@ -0,0 +1,40 @@
+'''
+Small transactions committed concurrently from several threads.  Commits queue up
+behind the one being written and are written together, so throughput should grow
+with the number of committers.
+'''
+
+import threading
+
+from reprisedb import database
+
+from benchmarks import tempdir, timed, report
+
+COMMITS = 400
+
+def run(db, threads):
+    per_thread = COMMITS // threads
+    
+    def worker(n):
+        for x in xrange(per_thread):
+            t = db.begin()
+            t.put('people', n * per_thread + x, {'name': 'Person %d' % x})
+            t.commit()
+    
+    workers = [ threading.Thread(target=worker, args=(n, )) for n in range(threads) ]
+    for w in workers: w.start()
+    for w in workers: w.join()
+    
+    return per_thread * threads
+
+if __name__ == '__main__':
+    for threads in (1, 4, 16):
+        for group_size in (1, 64):
+            with tempdir() as path:
+                db = database.RepriseDB(path=path, commit_group_size=group_size)
+                t = db.begin()
+                t.create_collection('people')
+                t.commit()
+                
+                elapsed, count = timed(run, db, threads)
+                report("%2d threads, commit_group_size=%d" % (threads, group_size), count, elapsed, 'commits')
@@ -0,0 +1,52 @@
+'''
+Lookup latency on an index of a frequently updated field, before and after
+vacuuming away the '-' marks left by the updates.
+'''
+
+from reprisedb import database
+
+from benchmarks import tempdir, timed, report
+
+DOCUMENTS = 2000
+UPDATES = 50
+LOOKUPS = 200
+STATUSES = ['new', 'open', 'pending', 'closed']
+
+def load(db):
+    t = db.begin()
+    t.create_collection('tickets')
+    t.add_index('tickets', 'status')
+    t.bulk_put('tickets', ( (x, {'status': 'new'}) for x in xrange(DOCUMENTS) ))
+    t.commit()
+
+    for n in xrange(UPDATES):
+        t = db.begin()
+        t.bulk_put('tickets', ( (x, {'status': STATUSES[(x + n) % len(STATUSES)]}) for x in xrange(DOCUMENTS) ))
+        t.commit()
+
+def lookups(db):
+    t = db.begin()
+    found = 0
+    for n in xrange(LOOKUPS):
+        found += len(t.lookup('tickets', 'status', STATUSES[n % len(STATUSES)]))
+    return found
+
+if __name__ == '__main__':
+    with tempdir() as path:
+        db = database.RepriseDB(path=path)
+        load(db)
+
+        rds = db.get_rds('tickets.status')
+        print "Index entries before: %d" % len(list(rds.iter_revisions()))
+
+        elapsed, found = timed(lookups, db)
+        report("lookups before vacuum", LOOKUPS, elapsed, 'lookups')
+
+        elapsed, removed = timed(db.vacuum_index, 'tickets', db.current_commit())
+        report("vacuum", removed, elapsed, 'entries')
+        print "Index entries after: %d" % len(list(rds.iter_revisions()))
+
+        elapsed, found_after = timed(lookups, db)
+        report("lookups after vacuum", LOOKUPS, elapsed, 'lookups')
+
+        assert found == found_after
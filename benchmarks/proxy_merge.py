@@ -0,0 +1,34 @@
+'''
+Merged range scans over a ProxyDataStore of stacked ArchiveDataStores.
+'''
+
+from reprisedb import drivers, datastore
+
+from benchmarks import tempdir, timed, report
+
+KEYS = 20000
+
+def build_stack(path, count):
+    driver = drivers.LMDBDriver(path)
+    
+    stack = []
+    for n in range(count):
+        ds = datastore.ArchiveDataStore(driver.get_db('archive-%d' % n), '%s/archive-%d' % (path, n), 0)
+        # each archive holds an interleaved slice of the keys
+        ds.store(( ('%08d\x00' % k, 'value-%d' % k) for k in xrange(n, KEYS, count) ), n + 1)
+        stack.insert(0, ds)
+        
+    return datastore.ProxyDataStore(stack)
+
+def scan(ds):
+    count = 0
+    for _item in ds.iter_items():
+        count += 1
+    return count
+
+if __name__ == '__main__':
+    for count in (2, 8, 32):
+        with tempdir() as path:
+            ds = build_stack(path, count)
+            elapsed, rows = timed(scan, ds)
+            report("iter_items over %d archives" % count, rows, elapsed)
@@ -0,0 +1,76 @@
+'''
+Planned queries against the same queries written by hand as an index lookup,
+a get of each match and a filter - picking the index the planner would.
+'''
+
+import itertools
+
+from reprisedb import database
+
+from benchmarks import tempdir, timed, report
+
+DOCUMENTS = 20000
+QUERIES = 200
+CITIES = ['Leeds', 'York', 'Hull', 'Bath', 'Derby', 'Ely', 'Ripon', 'Wells']
+STATUSES = ['new', 'open', 'pending', 'blocked', 'review', 'testing', 'done', 'closed']
+
+def load(db):
+    t = db.begin()
+    t.create_collection('people')
+    t.add_index('people', 'city')
+    t.add_index('people', 'status')
+    t.add_index('people', [('city', 'string'), ('age', 'uint32')])
+    t.bulk_put('people', ( (x, {'name': 'Person %d' % x,
+                                'age': x % 90,
+                                'city': CITIES[x % len(CITIES)],
+                                'status': STATUSES[(x / 7) % len(STATUSES)]}) for x in xrange(DOCUMENTS) ))
+    t.commit()
+
+def planned(db, query, limit):
+    t = db.begin()
+    found = 0
+    for n in xrange(QUERIES):
+        found += len(t.find('people', query(n), limit=limit))
+    return found
+
+def by_hand(db, lookup, match, limit):
+    t = db.begin()
+    found = 0
+    for n in xrange(QUERIES):
+        items = ( t.get('people', pk) for pk in lookup(t, n) )
+        found += len(list(itertools.islice(( item for item in items if match(n, item) ), limit)))
+    return found
+
+def compare(db, name, query, lookup, match, limit=None):
+    t = db.begin()
+    print "%s: %r" % (name, t.explain('people', query(0)))
+
+    elapsed, found = timed(planned, db, query, limit)
+    report("%s - find" % name, QUERIES, elapsed, 'queries')
+
+    elapsed, found_by_hand = timed(by_hand, db, lookup, match, limit)
+    report("%s - by hand" % name, QUERIES, elapsed, 'queries')
+
+    assert found == found_by_hand, (found, found_by_hand)
+
+if __name__ == '__main__':
+    with tempdir() as path:
+        db = database.RepriseDB(path=path)
+        load(db)
+
+        compare(db, "compound range",
+                lambda n: {'age': {'$gte': 30}, 'city': CITIES[n % len(CITIES)]},
+                lambda t, n: t.lookup('people', 'city,age', (CITIES[n % len(CITIES)], 30), (CITIES[n % len(CITIES)], 1000)),
+                lambda n, item: True,
+                limit=50)
+
+        compare(db, "intersection",
+                lambda n: {'city': CITIES[n % len(CITIES)], 'status': STATUSES[n % len(STATUSES)]},
+                lambda t, n: t.lookup('people', 'city', CITIES[n % len(CITIES)]),
+                lambda n, item: item['status'] == STATUSES[n % len(STATUSES)])
+
+        compare(db, "residual filter",
+                lambda n: {'city': CITIES[n % len(CITIES)], 'name': {'$ne': 'Person %d' % n}},
+                lambda t, n: t.lookup('people', 'city', CITIES[n % len(CITIES)]),
+                lambda n, item: item['name'] != 'Person %d' % n,
+                limit=20)
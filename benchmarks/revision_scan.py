@@ -0,0 +1,37 @@
+'''
+RevisionDataStore.iter_items throughput for keys with long histories, stepping
+with cursor.next() (the default) against always seeking past each key.
+'''
+
+from reprisedb import drivers, datastore
+
+from benchmarks import tempdir, timed, report
+
+RECORDS = 100000
+
+def build(path, revisions):
+    driver = drivers.LMDBDriver(path)
+    ds = datastore.RevisionDataStore(driver.get_db('testing'), 0)
+    
+    keys = RECORDS // revisions
+    for r in xrange(1, revisions + 1):
+        ds.store(( ('%08d\x00' % k, 'value-%d-%d' % (k, r)) for k in xrange(keys) ), r)
+    
+    return ds, keys
+
+def scan(ds):
+    count = 0
+    for _item in ds.iter_items():
+        count += 1
+    return count
+
+if __name__ == '__main__':
+    for revisions in (1, 10, 1000):
+        with tempdir() as path:
+            ds, keys = build(path, revisions)
+            
+            for step in (False, True):
+                ds.step_keys = step
+                elapsed, rows = timed(scan, ds)
+                assert rows == keys
+                report("%d revisions, %s" % (revisions, 'step' if step else 'seek'), rows, elapsed, 'keys')
@@ -0,0 +1,57 @@
+'''
+Read throughput of one RepriseDB shared by a pool of reader threads, each read in
+its own short transaction, while a writer keeps committing.
+'''
+
+import random
+import threading
+
+from reprisedb import database
+
+from benchmarks import tempdir, timed, report
+
+DOCUMENTS = 10000
+READS = 40000
+
+def load(db):
+    t = db.begin()
+    t.create_collection('people')
+    t.bulk_put('people', ( (x, {'name': 'Person %d' % x}) for x in xrange(DOCUMENTS) ))
+    t.commit()
+    
+def run(db, threads):
+    per_thread = READS // threads
+    stop = threading.Event()
+    
+    def reader():
+        for _i in xrange(per_thread):
+            db.begin().get('people', random.randrange(DOCUMENTS))
+    
+    def writer():
+        n = 0
+        while not stop.is_set():
+            t = db.begin()
+            t.put('people', n % DOCUMENTS, {'name': 'Updated %d' % n})
+            t.commit()
+            n += 1
+    
+    w = threading.Thread(target=writer)
+    w.start()
+    
+    readers = [ threading.Thread(target=reader) for _i in range(threads) ]
+    for r in readers: r.start()
+    for r in readers: r.join()
+    
+    stop.set()
+    w.join()
+    
+    return per_thread * threads
+
+if __name__ == '__main__':
+    with tempdir() as path:
+        db = database.RepriseDB(path=path)
+        load(db)
+        
+        for threads in (1, 2, 4, 8):
+            elapsed, count = timed(run, db, threads)
+            report("%d reader threads" % threads, count, elapsed, 'reads')
@@ -0,0 +1,35 @@
+'''
+Repeated Transaction.get() of a hot set of documents, one short transaction per
+read, with and without the value cache.
+'''
+
+import random
+
+from reprisedb import database
+
+from benchmarks import tempdir, timed, report
+
+DOCUMENTS = 1000
+READS = 50000
+
+def load(db):
+    t = db.begin()
+    t.create_collection('people')
+    t.bulk_put('people', ( (x, {'name': 'Person %d' % x, 'tags': range(10), 'address': {'town': 'Town %d' % x}}) for x in xrange(DOCUMENTS) ))
+    t.commit()
+
+def reads(db, keys):
+    for k in keys:
+        db.begin().get('people', k)
+    return len(keys)
+
+if __name__ == '__main__':
+    keys = [ random.randrange(DOCUMENTS) for _i in xrange(READS) ]
+    
+    for size in (None, DOCUMENTS):
+        with tempdir() as path:
+            db = database.RepriseDB(path=path, value_cache=size)
+            load(db)
+            
+            elapsed, count = timed(reads, db, keys)
+            report("get with value_cache=%s" % size, count, elapsed, 'reads')
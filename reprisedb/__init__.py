@@ -2,5 +2,9 @@ NUL = '\x00'
 ONE = '\x01'
 DELETED = '\x10\x7F\x1B'  # DLE DEL ESC
 
+def is_deleted(value):
+    ' works for LMDB buffers as well as strings '
+    return value is not None and len(value) == len(DELETED) and str(value) == DELETED
+
 class RepriseDataError(Exception):
     pass
\ No newline at end of file
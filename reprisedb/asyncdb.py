@@ -0,0 +1,214 @@
+'''
+Non-blocking front end to RepriseDB for event driven servers.
+
+Every call is run on a bounded pool of worker threads and returns a `Future`
+straight away, so the event loop is never held up by LMDB.  Range scans are read
+in chunks, one pool task per chunk, so a long scan can't hog a worker either.
+
+Completion callbacks run on the worker thread - hand them back to the event loop
+with whatever it provides e.g. `reactor.callFromThread` under twisted.
+
+>>> adb = AsyncRepriseDB(db)                                    # doctest: +SKIP
+>>> t = adb.begin().result()                                    # doctest: +SKIP
+>>> t.get('people', 1).add_done_callback(lambda f: show(f.result()))  # doctest: +SKIP
+'''
+
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+import logging
+logger = logging.getLogger(__name__)
+
+class Future(object):
+    '''
+    Result of a call made on the pool.  Follows the interface of
+    `concurrent.futures.Future` so it is easy to wrap for a particular event loop.
+    '''
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        ' blocks until the call has finished then returns its result or raises its exception '
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for result")
+
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for result")
+
+        return None if self._exc_info is None else self._exc_info[1]
+
+    def add_done_callback(self, fn):
+        ' calls fn(future) when done - immediately if it already is '
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception("Error in callback %r", fn)
+
+class AsyncRepriseDB(object):
+    '''
+    Wraps a RepriseDB.  `workers` bounds the number of threads touching the
+    database at once, `chunk_size` is the default number of rows per scan chunk.
+    '''
+
+    def __init__(self, db, workers=8, chunk_size=100):
+        self.db = db
+        self.chunk_size = chunk_size
+        self._pool = ThreadPool(workers)
+
+    def submit(self, f, *args, **kwargs):
+        ' runs f(*args, **kwargs) on the pool and returns a Future of the result '
+        future = Future()
+        self._pool.apply_async(_run, (future, f, args, kwargs))
+        return future
+
+    def begin(self, commit=None, snapshot=False):
+        ' Future of an AsyncTransaction '
+        return self.submit(lambda: AsyncTransaction(self, self.db.begin(commit, snapshot)))
+
+    def current_commit(self):
+        return self.submit(self.db.current_commit)
+
+    def close(self):
+        ' waits for outstanding calls to finish '
+        self._pool.close()
+        self._pool.join()
+
+def _run(future, f, args, kwargs):
+    try:
+        result = f(*args, **kwargs)
+    except Exception:
+        future._set(exc_info=sys.exc_info())
+    else:
+        future._set(result)
+
+class AsyncTransaction(object):
+    '''
+    Wraps a Transaction.  Calls on one transaction are run one at a time, in
+    whatever order the pool gets to them, so wait for a put before reading it back.
+    '''
+
+    def __init__(self, adb, transaction):
+        self.adb = adb
+        self.transaction = transaction
+        self._lock = threading.Lock()
+
+    @property
+    def current_commit(self):
+        return self.transaction.current_commit
+
+    def _call(self, name, *args, **kwargs):
+        def locked():
+            with self._lock:
+                return getattr(self.transaction, name)(*args, **kwargs)
+        return self.adb.submit(locked)
+
+    def get(self, collection, key, default=None):
+        return self._call('get', collection, key, default)
+
+    def lookup(self, collection, accessor, start_key, end_key=None, offset=0, length=None):
+        return self._call('lookup', collection, accessor, start_key, end_key, offset, length)
+
+    def count(self, collection, start_key=None, end_key=None):
+        return self._call('count', collection, start_key, end_key)
+
+    def put(self, collection, pk, value, index=True, track=True):
+        return self._call('put', collection, pk, value, index, track)
+
+    def delete(self, collection, pk):
+        return self._call('delete', collection, pk)
+
+    def commit(self, c=None, autoresolve=True):
+        return self._call('commit', c, autoresolve)
+
+    def rollback(self, c=None):
+        return self._call('rollback', c)
+
+    def each(self, collection, start_key=None, end_key=None, chunk_size=None):
+        ' AsyncScan of (key, value) '
+        def factory(start):
+            return self.transaction.each(collection, start, end_key)
+        return AsyncScan(self, factory, lambda row: row[0], start_key, chunk_size)
+
+    def keys(self, collection, start_key=None, end_key=None, chunk_size=None):
+        ' AsyncScan of keys '
+        def factory(start):
+            return self.transaction.get_entry(collection).iter_keys(start, end_key)
+        return AsyncScan(self, factory, lambda row: row, start_key, chunk_size)
+
+class AsyncScan(object):
+    '''
+    Range scan read a chunk at a time.  Call `next_chunk()` again once the previous
+    chunk has arrived - an empty list means the scan is finished.
+
+    Each chunk is read in a fresh read transaction, starting from the last key of
+    the one before, so an idle scan doesn't pin an LMDB reader slot.  Reads are
+    bounded by the transaction's commit so the chunks still form one consistent view.
+    '''
+
+    def __init__(self, at, factory, key, start_key=None, chunk_size=None):
+        self.at = at
+        self.chunk_size = chunk_size or at.adb.chunk_size
+        self._factory = factory
+        self._key = key
+        self._start = start_key
+        self._last = None
+        self.finished = False
+
+    def next_chunk(self):
+        ' Future of a list of up to chunk_size rows '
+        return self.at.adb.submit(self._read)
+
+    def _read(self):
+        with self.at._lock:
+            if self.finished:
+                return []
+
+            resume = self._last is not None
+            i = self._factory(self._last if resume else self._start)
+
+            chunk = []
+            try:
+                for row in i:
+                    if resume:
+                        resume = False
+                        if self._key(row) == self._last: continue
+                    chunk.append(row)
+                    if len(chunk) == self.chunk_size: break
+                else:
+                    self.finished = True
+            finally:
+                i.close()
+
+            if chunk:
+                self._last = self._key(chunk[-1])
+
+            return chunk
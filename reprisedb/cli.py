@@ -26,23 +26,22 @@ def import_csv(db, collection, filename):
     if not collection in t.list_collections():
         t.create_collection(collection)
     
-    headers = None
-    
-    pk = 1
-    
-    with open(fullpath, 'rb') as f:
-        csvreader = csv.reader(f)
-        for line in csvreader:
-            
-            if headers is None:
-                headers = line
-                continue
-            
-            data = dict(zip(headers, [ parse_value(v) for v in line ]))
-            t.put(collection, pk, data)
-            pk += 1
-            
-            #if pk > 500: break
+    def rows():
+        headers = None
+        pk = 1
+        
+        with open(fullpath, 'rb') as f:
+            csvreader = csv.reader(f)
+            for line in csvreader:
+                
+                if headers is None:
+                    headers = line
+                    continue
+                
+                yield pk, dict(zip(headers, [ parse_value(v) for v in line ]))
+                pk += 1
+    
+    t.bulk_put(collection, rows())
             
     t.commit()
             
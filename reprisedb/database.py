@@ -1,8 +1,11 @@
-from reprisedb import packers, entries, drivers, utils, datastore
+from reprisedb import packers, entries, drivers, utils, datastore, query, RepriseDataError, is_deleted
 
 from contextlib import contextmanager
+import copy
 import hashlib
 import itertools
+import threading
+import time
 
 from sortedcontainers import SortedDict
 
@@ -28,16 +31,39 @@ class RepriseDB(object):
         path = config.pop('path', 'data')
          
         driver = config.pop('driver', drivers.LMDBDriver)
+        
+        # bytes of pending writes per datastore before a transaction spills to disk
+        self.buffer_size = config.pop('buffer_size', None)
+        
+        # read values as LMDB buffers - see RevisionDataStore
+        self.buffers = config.pop('buffers', False)
+        
+        # number of packed values to cache - see RevisionDataStore.get_value()
+        value_cache = config.pop('value_cache', None)
+        self.value_cache = utils.ValueCache(value_cache) if value_cache else None
+        
+        # most transactions to write in one driver transaction - see `_commit()`
+        self.commit_group_size = config.pop('commit_group_size', 64)
          
         self.driver = driver(path, **config)
         
+        # shared Collections, valid for transactions from _meta_commit onwards
         self._collections = {}
+        self._meta_commit = 0
+        self._system_collections = {'_meta': Collection(self.META_META),
+                                    '_commits': Collection(self.COMMIT_META)}
         
         self.meta_entry = entries.Entry(packers.p_string, packers.p_obj)
         
         self._rds = {}
+        self._lock = threading.RLock()
+        
+        self._commit_cond = threading.Condition()
+        self._commit_queue = []
+        self._committing = False
         
         self._current_commit = 0 # need to set to something
+        self._version = None
         t = self.begin()
         self._current_commit = t.get('_commits', 0)
        
@@ -45,7 +71,13 @@ class RepriseDB(object):
             logger.debug("Initialising database")
             self._current_commit = 0
             t.put('_meta', 'info:version', '0.1.1', False)
-            assert t.commit(0) == 1
+            try:
+                assert t.commit(0) == 1
+            except RepriseDBIntegrityError:
+                logger.debug("Initialised by another process")
+        
+        # don't know when _meta last changed
+        self._meta_commit = self._current_commit
         
         logger.debug("Current commit: %s", self._current_commit)
     
@@ -53,25 +85,337 @@ class RepriseDB(object):
         return "collection:{0}".format(collection)
     
     def get_rds(self, name):
-        if not name in self._rds:
-            self._rds[name] = datastore.RevisionDataStore(self.driver.get_db(name), self._current_commit)
-        return self._rds[name]
+        rds = self._rds.get(name)
+        
+        if rds is None:
+            # opening can wait on a commit in progress so not under our lock
+            db = self.driver.get_db(name)
+            
+            with self._lock:
+                if not name in self._rds:
+                    self._rds[name] = datastore.RevisionDataStore(db, self._current_commit,
+                                                                  buffers=self.buffers, cache=self.value_cache)
+                rds = self._rds[name]
+        
+        return rds
+    
+    def drop_db(self, name):
+        ' removes a datastore\'s database from the driver '
+        with self._lock:
+            self._rds.pop(name, None)
+        self.driver.drop_db(name)
     
     def current_commit(self):
+        self.refresh()
         return self._current_commit
     
-    def begin(self, commit=None):
-        if commit is None: commit = self._current_commit
-        return Transaction(self, commit)
+    def get_collection(self, name, commit):
+        '''
+        Returns the Collection for name as of commit.  Collections are cached and shared
+        between transactions until a commit touches `_meta` so must not be modified.
+        '''
+        if name in self._system_collections:
+            return self._system_collections[name]
+        
+        if commit < self._meta_commit:
+            # older than the cache
+            return self._load_collection(name, commit)
+        
+        c = self._collections.get(name)
+        if c is None:
+            c = self._load_collection(name, commit)
+            
+            with self._lock:
+                # unless _meta has changed while loading
+                if self._meta_commit <= commit:
+                    c = self._collections.setdefault(name, c)
+        return c
+    
+    def _load_collection(self, name, commit):
+        meta_entry = entries.BoundEntry(self.meta_entry, self.get_rds('_meta'), commit)
+        return Collection(meta_entry.get(self.meta_key(name)))
+    
+    def _meta_changed(self, commit):
+        with self._lock:
+            self._collections.clear()
+            self._meta_commit = commit
+    
+    def begin(self, commit=None, snapshot=False):
+        '''
+        Start a new transaction.  With `snapshot` the transaction makes all its
+        reads within one long lived driver read transaction.
+        '''
+        if commit is None: commit = self.current_commit()
+        return Transaction(self, commit, snapshot)
+        
+    def job_state(self, key):
+        '''
+        Progress saved by a background job e.g. `PruneJob`, or None.  Kept in an
+        unrevisioned driver database so checkpoints don't add to the commit log.
+        '''
+        try:
+            _r, v = self._job_store().get_item(key)
+        except KeyError:
+            return None
+        return packers.p_obj.unpack(v)
+    
+    def save_job_state(self, key, state):
+        ' a state of None clears it '
+        self._job_store().store([(key, packers.p_obj.pack(state))])
         
-    def _try_commit(self, commit):
+    def _job_store(self):
+        return datastore.ScratchDataStore(self.driver.get_db('_jobs'))
+    
+    def vacuum_index(self, collection, before_commit, accessor=None, batch_size=1000):
+        '''
+        Physically removes the '-' marks of an index (all of the collection's indexes if
+        accessor is None), along with the '+' marks they cancel, once they are older
+        than before_commit.  Lookups at before_commit or later are unchanged, older
+        ones may find removed entries - so it is up to the caller to pick a commit no
+        reader still needs e.g. `commit_after(time.time() - max_age)`.
+        
+        Runs a write transaction per batch_size index keys.  Returns the number of
+        entries removed.
+        '''
+        c = self.get_collection(collection, before_commit)
+        accessors = c.meta['indexes'].keys() if accessor is None else [accessor]
+        
+        removed = 0
+        for a in accessors:
+            db, indexer = c.get_indexer(a)
+            n = self.get_rds(db).vacuum(before_commit, batch_size, indexer.is_tombstone)
+            logger.debug("Vacuumed %s: %d entries removed", db, n)
+            removed += n
+        
+        return removed
+    
+    def commit_after(self, timestamp):
+        '''
+        Returns the first commit made at or after timestamp (seconds since the epoch)
+        or the next commit number if there are none.  Commits recorded without a
+        timestamp count as older than any timestamp.
+        '''
+        t = self.begin()
         
-        if commit != self._current_commit:
-            raise RepriseDBIntegrityError("Current commit is %d" % self._current_commit)
+        lo, hi = 1, self._current_commit + 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = t.get('_commits', mid) or {}
+            if record.get('timestamp', 0) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+    
+    def _commit(self, t, commit, autoresolve):
+        '''
+        Commits the transaction t which was read at commit.
+        
+        Committers queue up and whoever finds no commit in progress becomes the leader,
+        writing everything queued (up to commit_group_size transactions) in one driver
+        write transaction.  Each transaction still gets its own commit number and
+        `_commits` record, but the number of syncs is per group rather than per commit.
+        '''
+        request = _CommitRequest(t, commit, autoresolve)
+        
+        with self._commit_cond:
+            self._commit_queue.append(request)
+            
+            while not request.done:
+                if self._committing:
+                    self._commit_cond.wait()
+                    continue
+                
+                self._committing = True
+                group = self._commit_queue[:self.commit_group_size]
+                del self._commit_queue[:self.commit_group_size]
+                
+                # others can queue while we write
+                self._commit_cond.release()
+                try:
+                    self._write_group(group)
+                finally:
+                    self._commit_cond.acquire()
+                    self._committing = False
+                    self._commit_cond.notify_all()
+                    
+        if request.error is not None:
+            raise request.error
         
-        self._current_commit += 1
-        return self._current_commit
+    def _write_group(self, group):
+        '''
+        Writes the group in one driver write transaction.  Transactions only move on
+        to their new commit once it has succeeded, and if it fails each is written on
+        its own so one bad transaction doesn't fail the rest.
+        '''
+        accepted = []
+        
+        try:
+            # the driver write transaction serializes commits between processes too
+            with self.driver.begin(write=True) as txn:
+                # holding the writer lock so the stored counter is authoritative
+                self.refresh(force=True)
+                accepted = self._number_group(group)
+                
+                # data, indexes and commit records are atomic where the driver supports it
+                for request in accepted:
+                    request.transaction._write(txn, request.number)
+        except Exception as e:
+            if len(accepted) > 1:
+                logger.debug("Group commit failed, writing %d transactions separately: %r", len(accepted), e)
+                for request in accepted:
+                    self._write_group([request])
+                return
+            
+            for request in group:
+                if not request.done:
+                    request.error = e
+                    request.done = True
+            return
+        
+        for request in accepted:
+            request.transaction.current_commit = request.number
+        
+        # before the commits are visible so no new transaction can see stale metadata
+        meta_commits = [ request.number for request in accepted 
+                         if _changes_meta(request.transaction._updates) ]
+        if meta_commits:
+            self._meta_changed(meta_commits[-1])
+        
+        if accepted:
+            # a refresh() may already have seen later commits by other processes
+            with self._lock:
+                self._current_commit = max(self._current_commit, accepted[-1].number)
+        
+        for request in accepted:
+            request.done = True
+            
+    def _number_group(self, group):
+        ' gives each commitable transaction in the group the next commit number '
+        current = self._current_commit
+        accepted = []
+        
+        # (collection, key) written by transactions earlier in the group
+        updated = set()
+        
+        # indexes of the collections whose metadata they changed
+        indexes = {}
+        
+        for request in group:
+            t = request.transaction
+            try:
+                if request.commit != current:
+                    # try and resolve them
+                    if not request.autoresolve or t.conflicts() is not None or \
+                       any( (n, k) in updated for n, keys in t._updates.iteritems() for k in keys ):
+                        raise RepriseDBIntegrityError("Current commit is %d" % current)
+                
+                self._check_indexes(t, request.commit, current, indexes)
+                
+                updated.update( (n, k) for n, keys in t._updates.iteritems() for k in keys )
+                for name in _meta_collections(t._updates):
+                    try:
+                        indexes[name] = t.get_collection(name).meta['indexes']
+                    except KeyError:
+                        # dropped
+                        indexes[name] = {}
+                current += 1
+                request.number = current
+                accepted.append(request)
+            except Exception as e:
+                request.error = e
+                request.done = True
+                
+        return accepted
+    
+    def _check_indexes(self, t, commit, current, group_indexes):
+        '''
+        Raises if t updated a collection that has gained an index since commit - its
+        puts weren't indexed there.  group_indexes has the indexes of collections
+        changed by transactions earlier in the group, which aren't written yet.
+        '''
+        for name in t._updates:
+            if name in self._system_collections:
+                continue
+            
+            if name in group_indexes:
+                indexes = group_indexes[name]
+            elif commit < self._meta_commit:
+                try:
+                    indexes = self.get_collection(name, current).meta['indexes']
+                except KeyError:
+                    # created by t
+                    continue
+            else:
+                continue
+            
+            added = set(indexes) - set(t.get_collection(name).meta['indexes'])
+            if added:
+                raise RepriseDBIntegrityError("Indexes added to %s since commit %d: %s" % (name, commit, ', '.join(sorted(added))))
+    
+    def refresh(self, force=False):
+        '''
+        Catches up with commits made by other processes using the same data directory.
+        Only reads the commit counter if the driver reports a write since the last call,
+        unless `force` is set.
+        '''
+        version = self.driver.version()
+        if not force and (version is None or version == self._version):
+            return
+        
+        with self._lock:
+            self._version = version
+            
+            try:
+                stored = self.get_rds('_commits').get_value(packers.p_uint32.pack(0), packers.p_obj.unpack)[1]
+            except KeyError:
+                return
+            
+            if stored <= self._current_commit:
+                return
+            
+            logger.debug("Commits %d to %d made elsewhere", self._current_commit + 1, stored)
+            
+            t = Transaction(self, stored)
+            for c in xrange(self._current_commit + 1, stored + 1):
+                record = t.get('_commits', c) or {}
+                if _changes_meta(record.get('updates', {})):
+                    self._collections.clear()
+                    self._meta_commit = c
+            
+            self._current_commit = stored
               
+def _changes_meta(updates):
+    ' True if the updates of a commit include collection metadata '
+    return any( k.startswith('collection:') for k in updates.get('_meta', ()) )
+
+def _meta_collections(updates):
+    ' names of the collections whose metadata the updates of a commit include '
+    return [ k[11:] for k in updates.get('_meta', ()) if k.startswith('collection:') ]
+
+class _CommitRequest(object):
+    
+    def __init__(self, transaction, commit, autoresolve):
+        self.transaction = transaction
+        self.commit = commit
+        self.autoresolve = autoresolve
+        self.number = None
+        self.done = False
+        self.error = None
+        
+def index_name(accessor):
+    '''
+    Name of the index on accessor - compound indexes are given as a sequence of
+    accessors or (accessor, value_packer) pairs
+    
+    >>> index_name([('status', 'string'), ('created', 'uint32')])
+    'status,created'
+    '''
+    if isinstance(accessor, basestring):
+        return accessor
+    
+    return ','.join( a if isinstance(a, basestring) else a[0] for a in accessor )
+
 class Collection(object):
     '''
     A collection is an Entry (controlled by a key_packer and value_packer) and
@@ -92,59 +436,104 @@ class Collection(object):
         result = []
         
         for accessor in self.meta['indexes']:
-            new_value = utils.dotted_accessor(new_item, accessor)
-            old_value = utils.dotted_accessor(old_item, accessor)
+            result.extend(self.index_changes(accessor, pk, new_item, old_item))
             
-            if new_value != old_value:
-                
-                db, indexer = self.get_indexer(accessor)
-                
-                if old_value != None:
-                    k, v = indexer.prepare(old_value, pk, '-')
-                    result.append((db, k, v))
-                
-                if new_value != None:
-                    k, v = indexer.prepare(new_value, pk, '+')
-                    result.append((db, k, v))
+        return result
+    
+    def index_changes(self, accessor, pk, new_item, old_item):
+        ' (db, key, mark) for the index on accessor when pk changes from old_item to new_item '
+        db, indexer = self.get_indexer(accessor)
+        
+        new_value = indexer.extract(new_item, accessor)
+        old_value = indexer.extract(old_item, accessor)
+        
+        result = []
+        
+        if new_value != old_value:
+            
+            if old_value != None:
+                k, v = indexer.prepare(old_value, pk, '-')
+                result.append((db, k, v))
             
+            if new_value != None:
+                k, v = indexer.prepare(new_value, pk, '+', new_item)
+                result.append((db, k, v))
+                
+        elif new_value != None and indexer.projection_changed(new_item, old_item):
+            # same index key, new projection
+            k, v = indexer.prepare(new_value, pk, '+', new_item)
+            result.append((db, k, v))
             
         return result
     
+    def index_history(self, accessor, revisions):
+        '''
+        Index (btkey, mark) pairs for every revision in revisions - (db key, packed revision,
+        value) in datastore order, newest first for each key
+        '''
+        for k, history in itertools.groupby(revisions, lambda x: x[0]):
+            pk = self.entry.from_db_key(k)
+            old_item = None
+            
+            for _k, r, v in reversed(list(history)):
+                new_item = None if v is None or is_deleted(v) else self.entry.from_db_value(v)
+                
+                for _db, ik, iv in self.index_changes(accessor, pk, new_item, old_item):
+                    yield ik + r, iv
+                    
+                old_item = new_item
+    
+    def is_building(self, accessor):
+        ' True while an index added with `online` is being built '
+        return index_name(accessor) in self.meta.get('building', ())
+    
     def get_indexer(self, accessor):
+        accessor = index_name(accessor)
+        
         if not accessor in self._indexes:
             if not accessor in self.meta['indexes']:
                 raise KeyError("No index available for %s" % accessor)
             
-            index_type, value_packer = self.meta['indexes'][accessor]
+            index_type, value_packer = self.meta['indexes'][accessor][:2]
             index_cls = getattr(entries, index_type)
-            self._indexes[accessor] = index_cls(self.key_packer, packers.registry[value_packer])
+            
+            if isinstance(value_packer, list):
+                value_packer = [ packers.registry[p] for p in value_packer ]
+            else:
+                value_packer = packers.registry[value_packer]
+            
+            # any further settings are specific to the index type
+            self._indexes[accessor] = index_cls(self.key_packer, value_packer,
+                                                *self.meta['indexes'][accessor][2:])
             
         return "{0}.{1}".format(self.name, accessor), self._indexes[accessor]
     
 class Transaction(object):
     
-    def __init__(self, db, current_commit):
+    def __init__(self, db, current_commit, snapshot=False):
         self.db = db
         self.current_commit = current_commit
+        self.snapshot = snapshot
+        self._snapshot = None
         
         self._datastores = SortedDict()
         self._updates = {}
         
         self._collections = {}
-        
-        self._collections['_meta'] = Collection(self.db.META_META)
-        self._collections['_commits'] = Collection(self.db.COMMIT_META)
         self._post_commit = []
         
     def get_collection(self, name):
         
         if not name in self._collections:
-            # manually pull the meta
-            meta_entry = entries.BoundEntry(self.db.meta_entry, self.db.get_rds('_meta'), self.current_commit)
-            meta = meta_entry.get(self.db.meta_key(name))
-            self._collections[name] = Collection(meta)
+            self._collections[name] = self.db.get_collection(name, self.current_commit)
         
         return self._collections[name]
+    
+    def _own_collection(self, name):
+        ' a copy of the collection for this transaction to modify '
+        c = Collection(copy.deepcopy(self.get_collection(name).meta))
+        self._collections[name] = c
+        return c
 
     def create_collection(self, name, key_packer='p_uint32', value_packer='p_dict'):
          
@@ -175,83 +564,122 @@ class Transaction(object):
         def cleanup():
             logger.debug("Cleaning up database files")
             for f in to_remove:
-                self.db.driver.drop_db(f)
+                self.db.drop_db(f)
         
         self._post_commit.append(cleanup)
         self.delete('_meta', self.db.meta_key(name))
         
-        del self._collections[name]
+        self._collections.pop(name, None)
       
     def list_collections(self):
         return [ x[11:] for x in self.keys('_meta', start_key='collection:', end_key='collection:~') ]
     
-    def add_index(self, collection, accessor, value_packer='string'):
-        c = self.get_collection(collection)
+    def add_index(self, collection, accessor, value_packer='string', covering=None, online=False):
+        '''
+        Indexes the collection on accessor.  Give a list of accessors as `covering`
+        to store those fields in the index too, for use with `lookup_items()`.
+        
+        For a compound index give accessor as a list of (accessor, value_packer)
+        pairs e.g. `[('status', 'string'), ('created', 'uint32')]`.  It is then
+        looked up by a tuple of values, or a leading part of one.
+        
+        The existing history is indexed straight away unless `online` is set, in
+        which case it is left to an `IndexBuilder` once this is committed.  Until
+        that finishes lookups scan the collection instead.
+        '''
+        c = self._own_collection(collection)
+        
+        if isinstance(accessor, basestring):
+            fields = [(accessor, value_packer)]
+        else:
+            fields = [ tuple(f) for f in accessor ]
+            if covering:
+                raise Exception("Compound indexes can't be covering")
+            
+            # a list of one field is a simple index with that field's packer
+            value_packer = fields[0][1]
+        accessor = index_name(accessor)
          
         current = c.meta['indexes']
         if accessor in current:
             raise Exception("Already an index on %s" % accessor)
          
-        if not value_packer in packers.registry:
-            raise Exception("Unknown value packer: %s" % value_packer)
+        for _a, p in fields:
+            if not p in packers.registry:
+                raise Exception("Unknown value packer: %s" % p)
          
-        current[accessor] = ['SimpleIndex', value_packer]
-        
-        db, indexer = c.get_indexer(accessor)
-        
-        rds = self.db.get_rds(db)
-        
-        def g():
-            pk = pr = pv = None
+        if len(fields) > 1:
+            current[accessor] = ['CompoundIndex', [ p for _a, p in fields ], [ a for a, _p in fields ]]
+        elif covering:
+            current[accessor] = ['CoveringIndex', value_packer, list(covering)]
+        else:
+            current[accessor] = ['SimpleIndex', value_packer]
+        
+        if online:
+            # built by an IndexBuilder, maintained by puts from this commit on
+            c.meta.setdefault('building', []).append(accessor)
+        else:
+            db, _indexer = c.get_indexer(accessor)
             
+            # must be opened before the write transaction starts
             ds = self.get_datastore(collection)
             ds = ds.datastores[1] # TODO: FIX
             
-            for k, r, v in ds.iter_revisions(end_revision=self.current_commit):
-                k = c.entry.from_db_key(k)
-                v = c.entry.from_db_value(v)
-                
-                # will get them in latest to earliest order
-                if k == pk:
-                    # add an un-index for the previous key
-                    data = indexer.prepare(pv, pk, '-')
-                    yield data[0] + pr, data[1]
-                    
-                v = utils.dotted_accessor(v, accessor)
-                
-                if v is not None:
-                
-                    data = indexer.prepare(v, k, '+')
-                    #print "DATA", data
-                    yield data[0] + r, data[1]
-                
-                pk, pr, pv = k, r, v
-            
-        rds.raw_store(g())
+            self.db.get_rds(db).raw_store(c.index_history(accessor, ds.iter_revisions(end_revision=self.current_commit)))
          
         self.put('_meta', self.db.meta_key(collection), c.meta)
         
     def drop_index(self, collection, accessor):
-        c = self.get_collection(collection)
+        c = self._own_collection(collection)
         
+        accessor = index_name(accessor)
         db, _indexer = c.get_indexer(accessor)
         
+        building = c.is_building(accessor)
+        
         def cleanup():
             logger.debug("Removing index datafile for %s", db)
-            self.db.driver.drop_db(db)
+            self.db.drop_db(db)
+            if building:
+                IndexBuilder(self.db, collection, accessor)._checkpoint(None)
         
         del c.meta['indexes'][accessor]
         del c._indexes[accessor]
+        if building:
+            c.meta['building'].remove(accessor)
         
-        self._put('_meta', self.db.meta_key(collection), c.meta)
+        self._post_commit.append(cleanup)
+        self.put('_meta', self.db.meta_key(collection), c.meta)
     
     def get_datastore(self, name):
         if not name in self._datastores:
-            mds = datastore.MemoryDataStore()
+            mds = datastore.BufferDataStore(self.db.driver, self.db.buffer_size)
             
-            self._datastores[name] = datastore.ProxyDataStore((mds, self.db.get_rds(name)))
+            self._datastores[name] = datastore.ProxyDataStore((mds, self.get_rds(name)))
         return self._datastores[name]
     
+    def _clear_datastores(self):
+        for ds in self._datastores.itervalues():
+            ds.datastores[0].close()
+        self._datastores.clear()
+    
+    def get_rds(self, name):
+        ' RevisionDataStore to read `name` from - bound to our snapshot if we have one '
+        rds = self.db.get_rds(name)
+        
+        if self.snapshot:
+            if self._snapshot is None:
+                self._snapshot = self.db.driver.snapshot()
+            if self._snapshot is not None:
+                rds = rds.with_snapshot(self._snapshot)
+        
+        return rds
+    
+    def _release_snapshot(self):
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+    
     def get_entry(self, collection):
         return entries.BoundEntry(self.get_collection(collection).entry, self.get_datastore(collection), self.current_commit)
     
@@ -295,13 +723,62 @@ class Transaction(object):
         
         return True
     
-    def bulk_put(self, collection, items, index=True, track=True):
-        
+    def bulk_put(self, collection, items, index=True, track=True, batch_size=10000):
+        '''
+        Puts many items at once - same result as calling `put()` for each.
+        
+        Items are taken in batches which are sorted by packed key, so the old values
+        needed for tracking and index updates come from one sorted `iter_get` pass
+        and the datastores are written in key order.
+        '''
         if hasattr(items, 'iteritems'):
             items = items.iteritems()
+        items = iter(items)
+        
+        c = self.get_collection(collection)
+        ds = self.get_datastore(collection)
+        
+        while True:
+            # sort is stable so repeated keys stay in the order given
+            batch = sorted(( (c.entry.to_db_key(pk), pk, value) for pk, value in itertools.islice(items, batch_size) ),
+                           key=lambda x: x[0])
+            if not batch: break
+            
+            if track:
+                old_values = ds.iter_get(( x[0] for x in batch ), self.current_commit)
+            else:
+                old_values = itertools.repeat((None, None, None))
+            
+            data = []
+            indexes = {}
+            previous_key = previous_value = None
+            
+            for (k, pk, value), (_k, _r, v) in itertools.izip(batch, old_values):
+                
+                if track:
+                    if k == previous_key:
+                        old_value = previous_value
+                    elif v is None or is_deleted(v):
+                        old_value = None
+                    else:
+                        old_value = c.entry.from_db_value(v)
+                    
+                    previous_key, previous_value = k, value
+                    
+                    if value == old_value:
+                        continue
+                
+                data.append((k, c.entry.to_db_value(value)))
+                self._updates.setdefault(collection, set()).add(pk)
+                
+                if track and index:
+                    for n, ik, iv in c.index_item(pk, value, old_value):
+                        indexes.setdefault(n, []).append((ik, iv))
+                        
+            ds.store(data)
             
-        for k, v in items:
-            self.put(collection, k, v, index, track)
+            for n, index_data in indexes.iteritems():
+                self.get_datastore(n).store(index_data)
     
     def delete(self, collection, pk):
         self.put(collection, pk, None)
@@ -310,13 +787,43 @@ class Transaction(object):
         return self.get_entry(collection).keys(start_key, end_key)
     
     def count(self, collection, start_key=None, end_key=None):
-        return len(self.keys(collection, start_key, end_key))
+        return self.get_entry(collection).count(start_key, end_key)
 
     def lookup(self, collection, accessor, start_key, end_key=None, offset=0, length=None):
         
-        index = self.get_index(collection, accessor)
+        if self.get_collection(collection).is_building(accessor):
+            i = ( pk for pk, _item in self._scan_index(collection, accessor, start_key, end_key) )
+        else:
+            i = self.get_index(collection, accessor).iter_lookup_keys(start_key, end_key)
         
-        i = index.iter_lookup_keys(start_key, end_key)
+        if offset or length:
+            if length is not None: length += offset
+            i = itertools.islice(i, offset, length)
+        
+        return list(i)
+    
+    def lookup_count(self, collection, accessor, start_key, end_key=None):
+        ' number of items `lookup()` would return '
+        if self.get_collection(collection).is_building(accessor):
+            return sum( 1 for _x in self._scan_index(collection, accessor, start_key, end_key) )
+        
+        return self.get_index(collection, accessor).count(start_key, end_key)
+    
+    def lookup_items(self, collection, accessor, start_key, end_key=None, offset=0, length=None):
+        '''
+        (pk, projection) for each match of a covering index.  Read from the index
+        alone - the collection itself is never touched.
+        '''
+        c = self.get_collection(collection)
+        
+        if c.is_building(accessor):
+            _db, indexer = c.get_indexer(accessor)
+            if not hasattr(indexer, 'project'):
+                raise RepriseDataError("Index does not store projections")
+            
+            i = ( (pk, indexer.project(item)) for pk, item in self._scan_index(collection, accessor, start_key, end_key) )
+        else:
+            i = self.get_index(collection, accessor).iter_lookup_items(start_key, end_key)
         
         if offset or length:
             if length is not None: length += offset
@@ -324,6 +831,42 @@ class Transaction(object):
         
         return list(i)
     
+    def find(self, collection, query, limit=None):
+        '''
+        (pk, item) for the items matching query - see `reprisedb.query`.  Uses
+        whichever indexes look most selective, otherwise scans the collection.
+        '''
+        return list(self.plan(collection, query).execute(limit))
+    
+    def explain(self, collection, query):
+        ' dict describing how `find()` would run query '
+        return self.plan(collection, query).explain()
+    
+    def plan(self, collection, q):
+        return query.Planner(self).plan(collection, q)
+    
+    def _scan_index(self, collection, accessor, start_key, end_key=None):
+        '''
+        (pk, item) for the items a lookup on an index would find, in index order, by
+        scanning the whole collection.  Used while the index is still being built.
+        '''
+        _db, indexer = self.get_collection(collection).get_indexer(accessor)
+        a, b = indexer.key_range(start_key, end_key)
+        
+        logger.debug("Index %s.%s is building - scanning", collection, index_name(accessor))
+        
+        matches = []
+        for pk, item in self.each(collection):
+            value = indexer.extract(item, accessor)
+            if value is None: continue
+            
+            k = indexer.to_db_key(value, pk)
+            if k >= a and (b is None or k < b):
+                matches.append((k, pk, item))
+        
+        matches.sort(key=lambda x: x[0])
+        return ( (pk, item) for _k, pk, item in matches )
+    
     def index(self, collection, accessor):
         c = self.get_collection(collection)
         
@@ -340,7 +883,7 @@ class Transaction(object):
                     # add an un-index for the previous key
                     yield indexer.prepare(pv, pk, '-')
                     
-                v = utils.dotted_accessor(v, accessor)
+                v = indexer.extract(v, accessor)
                 
                 yield indexer.prepare(v, k, '+')
                 
@@ -353,75 +896,276 @@ class Transaction(object):
         if c is None: c = self.current_commit
         
         # this throws an exception if the transaction is not commitable
-        try:
-            self.current_commit = self.db._try_commit(c)
-        except RepriseDBIntegrityError:
-            # try and resolve them
-            if autoresolve and self.conflicts() is None:
-                self.current_commit = self.db._try_commit(self.current_commit)
-            else:
-                raise
-        
-        commit = {'updates': { k: list(s) for k, s in self._updates.iteritems() },
-                  'checksum': ""}
-        #
-        self.put('_commits', self.current_commit, commit, track=False)
-        self.put('_commits', 0, self.current_commit, track=False)
+        self.db._commit(self, c, autoresolve)
         
-        # send the data to the datastores
-        for n, ds in self._datastores.iteritems():
-            ms = ds.datastores[0]
-            self.db.get_rds(n).store(ms.iteritems(), self.current_commit)
+        # can't drop databases while we are still reading from them
+        self._release_snapshot()
         
         for m in self._post_commit:
             m()
         
         self._post_commit = []
-        self._datastores.clear()
+        self._clear_datastores()
         self._updates = {}
         
         return self.current_commit
     
+    def _write(self, txn, commit):
+        ' sends the data and commit records to the datastores as part of the driver transaction txn '
+        for n, ds in self._datastores.iteritems():
+            ms = ds.datastores[0]
+            self.db.get_rds(n).store(ms.iteritems(), commit, txn, append=True)
+        
+        record = {'updates': { k: list(s) for k, s in self._updates.iteritems() },
+                  'checksum': "",
+                  'timestamp': time.time()}
+        
+        entry = self.get_collection('_commits').entry
+        self.db.get_rds('_commits').store([entry.prepare(0, commit), entry.prepare(commit, record)], commit, txn, append=True)
+    
     def rollback(self, c=None):
         
         if c is None:
             c = self.db.current_commit()
         
         self._post_commit = []
-        self._datastores.clear()
+        self._clear_datastores()
         self._updates = {}
+        self._release_snapshot()
         
         self.current_commit = c
         
         return c
     
     def conflicts(self):
+        '''
+        Returns a list of (collection, key, commit) for every key this transaction has
+        updated that has been changed by a later commit, or None if there are none (in
+        which case the transaction is moved on to the current commit).
+        
+        Each collection's datastore already records the commit of every change so this
+        is one sorted `iter_get()` of the updated keys per collection.
+        '''
         result = []
         
         logger.debug("Checking for conflicts: %r", self._updates)
         
         current = self.db.current_commit()
-        for c in xrange(self.current_commit+1, current+1):
-            t = self.db.begin(commit=c)
-            commit = t.get('_commits', c)
+        for n, items in self._updates.iteritems():
+            entry = self.get_collection(n).entry
+            rds = self.db.get_rds(n)
+            
+            keys = sorted( (entry.to_db_key(k), k) for k in items )
+            latest = rds.iter_get(( x[0] for x in keys ), current)
             
-            # compare the changes
-            for n, items in commit['updates'].iteritems():
-                for k in self._updates.setdefault(n, set()) & set(items):
+            for (_dk, k), (_k, r, _v) in itertools.izip(keys, latest):
+                if r is None: continue
+                
+                c = rds.unpack_revision(r)
+                if c > self.current_commit:
                     logger.debug("CONFLICT: %r, %r, %r", n, k, c)
                     result.append((n, k, c))
-            
-            if not result:
-                logger.debug("Non blocking commit: %d", c)
-                self.current_commit = c
         
         if result == []:
             logger.debug("No blocking commits found")
+            self._move_to(current)
             return None
         
         logger.debug("Blocking commits: %r", result)
         return result
+    
+    def _move_to(self, commit):
+        ' moves the transaction on to commit, replacing a snapshot taken before it '
+        if commit != self.current_commit and self._snapshot is not None:
+            self._release_snapshot()
+            for n, ds in self._datastores.iteritems():
+                ds.datastores = (ds.datastores[0], self.get_rds(n))
+        
+        self.current_commit = commit
+        
+
+class Job(object):
+    '''
+    Base for background work done batch_size keys at a time, such as `PruneJob` and
+    `IndexBuilder`.  The state of a run is checkpointed under `meta_key` with
+    `RepriseDB.save_job_state()` every checkpoint_batches batches, and when the run
+    uses up its budget, so the next run carries on where it left off.
+    '''
+    
+    def __init__(self, db, batch_size=1000, checkpoint_batches=10):
+        self.db = db
+        self.batch_size = batch_size
+        self.checkpoint_batches = checkpoint_batches
+        
+    def state(self):
+        ' the checkpointed state of the job or None if it is not running '
+        return self.db.job_state(self.meta_key)
+    
+    def _checkpoint(self, state):
+        self.db.save_job_state(self.meta_key, state)
+        
+    def _next_batch(self, rds, start_key):
+        ' (number of keys, key to start the next batch from or None) for the batch from start_key '
+        keys = list(rds.iter_keys(start_key, self.batch_size + 1))
+        if len(keys) > self.batch_size:
+            return self.batch_size, keys[self.batch_size]
+        return len(keys), None
+    
+    def _batch_done(self, budget, state, keys):
+        '''
+        Counts a batch of keys against the budget, checkpointing state if it is due.
+        Returns False if the budget has run out.
+        '''
+        budget.spend(keys)
+        
+        if budget.exhausted():
+            self._checkpoint(state)
+            return False
+        
+        if budget.batches % self.checkpoint_batches == 0:
+            self._checkpoint(state)
+        return True
+    
+class _Budget(object):
+    ' time_budget seconds and ops_budget keys for one run of a job '
+    
+    def __init__(self, time_budget=None, ops_budget=None):
+        self.time_budget = time_budget
+        self.ops_budget = ops_budget
+        self.started = time.time()
+        self.ops = 0
+        self.batches = 0
+        
+    def spend(self, ops):
+        self.ops += ops
+        self.batches += 1
+        
+    def exhausted(self):
+        return (self.time_budget is not None and time.time() - self.started >= self.time_budget) or \
+               (self.ops_budget is not None and self.ops >= self.ops_budget)
+    
+class PruneJob(Job):
+    '''
+    Resumable prune of the revisions in a datastore (a collection or an index
+    e.g. "people.first_name").
+    
+    Keeps the last `keep` revisions of every key and, with max_age, every revision
+    committed in the last max_age seconds.  Each batch of keys is pruned in its own
+    write transaction.
+    '''
+    
+    def __init__(self, db, name, keep=3, max_age=None, batch_size=1000, checkpoint_batches=10):
+        Job.__init__(self, db, batch_size, checkpoint_batches)
+        self.name = name
+        self.keep = keep
+        self.max_age = max_age
+        
+    @property
+    def meta_key(self):
+        return "prune:{0}".format(self.name)
+    
+    def run(self, time_budget=None, ops_budget=None):
+        '''
+        Prunes batches until the end of the datastore or until time_budget seconds or
+        ops_budget keys have been used.  Returns True if the prune is complete.
+        '''
+        state = self.state()
+        if state is None:
+            before_revision = None
+            if self.max_age is not None:
+                before_revision = self.db.commit_after(time.time() - self.max_age)
+            state = {'start_key': None, 'before_revision': before_revision, 'pruned': 0}
+        
+        rds = self.db.get_rds(self.name)
+        budget = _Budget(time_budget, ops_budget)
+        
+        while True:
+            keys, end_key = self._next_batch(rds, state['start_key'])
+            for _item in rds.iter_prune(self.keep, state['start_key'], end_key, state['before_revision']):
+                state['pruned'] += 1
+            state['start_key'] = end_key
+            
+            if end_key is None:
+                logger.debug("Prune of %s complete: %d revisions removed", self.name, state['pruned'])
+                self._checkpoint(None)
+                return True
+            
+            if not self._batch_done(budget, state, keys):
+                return False
+            
+class IndexBuilder(Job):
+    '''
+    Builds an index added with `add_index(..., online=True)`.
+    
+    Puts maintain the index from the commit that added it - commits read from before
+    it are refused - so only the history up to the commit the build starts at needs
+    indexing.  Each batch of keys is indexed in its own write transaction, and once
+    the history is done the index is marked ready.
+    '''
+    
+    def __init__(self, db, collection, accessor, batch_size=1000, checkpoint_batches=10):
+        Job.__init__(self, db, batch_size, checkpoint_batches)
+        self.collection = collection
+        self.accessor = index_name(accessor)
+        
+    @property
+    def meta_key(self):
+        return "index:{0}.{1}".format(self.collection, self.accessor)
+    
+    def run(self, time_budget=None, ops_budget=None):
+        '''
+        Builds until the index is ready or until time_budget seconds or ops_budget keys
+        have been used.  Returns True if the index is ready (or has been dropped).
+        '''
+        commit = self.db.current_commit()
+        if not self.db.get_collection(self.collection, commit).is_building(self.accessor):
+            self._checkpoint(None)
+            return True
+        
+        state = self.state()
+        if state is None:
+            state = {'start_key': None, 'commit': commit}
+            
+        c = self.db.get_collection(self.collection, state['commit'])
+        rds = self.db.get_rds(self.collection)
+        index_rds = self.db.get_rds(c.get_indexer(self.accessor)[0])
+        budget = _Budget(time_budget, ops_budget)
+        
+        while True:
+            keys, end_key = self._next_batch(rds, state['start_key'])
+            
+            index_rds.raw_store(c.index_history(self.accessor, rds.iter_revisions(end_revision=state['commit'],
+                                                                                  start_key=state['start_key'],
+                                                                                  end_key=end_key)))
+            state['start_key'] = end_key
+            
+            if end_key is None:
+                break
+            
+            if not self._batch_done(budget, state, keys):
+                return False
+        
+        while True:
+            t = self.db.begin()
+            meta = t._own_collection(self.collection).meta
+            if not self.accessor in meta.get('building', ()):
+                # dropped
+                break
+            
+            meta['building'].remove(self.accessor)
+            t.put('_meta', self.db.meta_key(self.collection), meta)
+            
+            try:
+                t.commit()
+            except RepriseDBIntegrityError:
+                logger.debug("Metadata of %s changed during build of %s - retrying", self.collection, self.accessor)
+                continue
+            
+            logger.debug("Index %s ready", self.meta_key)
+            break
         
+        self._checkpoint(None)
+        return True
             
 if __name__ == '__main__':
     
@@ -9,8 +9,18 @@ A DataStore implements a basic interface
 '''
 
 from sortedcontainers import SortedDict
-import zipfile, base64
-import packers
+from contextlib import contextmanager
+import collections
+import copy
+import heapq
+import itertools
+import struct
+import zlib
+import mmap
+import multiprocessing
+import os.path
+import packers, utils
+from reprisedb import is_deleted
 import logging
 logger = logging.getLogger(__name__)
 
@@ -19,98 +29,217 @@ class RevisionDataStore(object):
     Revision based datastore using LMDB backend.
     
     btkeys are in the format '<key><revision>' where revision is a 4 byte inverse uint32
+    
+    If `snapshot` is given (see `drivers.LMDBSnapshot`) all reads are made within
+    it instead of opening a read transaction per call.
+    
+    With `buffers` the LMDB read transactions return buffers pointing into the mapped
+    pages.  Revisions are compared without slicing keys and `iter_items()` yields
+    values as buffers, so only values that actually get decoded are copied.  They
+    are only valid until the iterator is exhausted.
+    
+    If `cache` is a `utils.ValueCache` then `get_value()` keeps the unpacked values
+    it reads there.
     '''
     
     revision_packer = packers.p_revision
+    
+    # iter_items() steps from key to key with cursor.next() - whenever that lands on an
+    # older revision it seeks past the history and seeks for the next `seek_run` keys
+    step_keys = True
+    seek_run = 8
 
-    def __init__(self, env, current_revision):
+    def __init__(self, env, current_revision, snapshot=None, buffers=False, cache=None):
         self.env = env
         self.current_revision = current_revision
+        self.snapshot = snapshot
+        self.buffers = buffers
+        self.cache = cache
+        
+    def with_snapshot(self, snapshot):
+        ' Returns a copy of this datastore that reads from `snapshot` '
+        ds = copy.copy(self)
+        ds.snapshot = snapshot
+        return ds
+    
+    @contextmanager
+    def read_cursor(self, buffers=False):
+        '''
+        Cursor for a range read.  Has its own position so is safe to hold across
+        yields.
+        '''
+        if self.snapshot is None:
+            with self.env.begin(buffers=buffers) as txn:
+                with txn.cursor() as c:
+                    yield c
+        else:
+            with self.env.cursor(self.snapshot.txn) as c:
+                yield c
+                
+    @contextmanager
+    def seek_cursor(self):
+        '''
+        Cursor for point reads.  Shared within a snapshot so every access must
+        start with an absolute seek.
+        '''
+        if self.snapshot is None:
+            with self.read_cursor(self.buffers) as c:
+                yield c
+        else:
+            yield self.snapshot.cursor(self.env)
+            
+    def revision_at(self, btkey):
+        ' Inverted revision of a btkey as an integer, read in place '
+        return self.revision_packer.packer.unpack_from(btkey, len(btkey) - 4)[0]
+    
+    def _match(self, btkey, key, last):
+        ' True if `btkey` is a revision of `key` no older than the inverted revision `last` '
+        return len(btkey) == len(key) + 4 and self.revision_at(btkey) <= last and btkey[:-4] == key
 
     def unpack_revision(self, r):
         ' Returns revision as an integer '
         return self.revision_packer.unpack(r)
 
-    def store(self, data, revision):
+    def store(self, data, revision, txn=None, append=False):
         '''
         data should be a list of (key, value) tuples
+        
+        If `txn` is a driver level write transaction the data is written as
+        part of it, otherwise a transaction is opened just for this store.
+        
+        Set `append` if the data is sorted by key - see `raw_store()`.
         '''
         if self.current_revision > revision:
             raise Exception("Cannot revision version %d, already at %d" % (revision, self.current_revision))
         
         items = ( (self.revision_packer.append_last(key, revision), value) for key, value in data )
         
-        added = self.raw_store(items)
+        added = self.raw_store(items, txn, append)
         self.current_revision = revision
         
         return added
     
-    def raw_store(self, data):
+    def raw_store(self, data, txn=None, append=False):
+        '''
+        Writes (btkey, value) pairs.  If `append` is set the caller guarantees the data
+        is sorted by btkey and if it all falls after the existing keys it is appended to
+        the end of the tree rather than each key being searched for.
+        '''
+        if self.cache is not None:
+            data = self._invalidate(data)
         
-        with self.env.begin(write=True) as txn:
-            with txn.cursor() as c:
-                consumed, _added = c.putmulti(data)
-                
+        if txn is None:
+            with self.env.begin(write=True) as txn:
+                with txn.cursor() as c:
+                    return self._putmulti(c, data, append)
+        
+        with self.env.cursor(txn) as c:
+            return self._putmulti(c, data, append)
+        
+    def _invalidate(self, data):
+        for btkey, v in data:
+            self.cache.invalidate((self.env, btkey[:-4]), self.unpack_revision(btkey[-4:]))
+            yield btkey, v
+        
+    def _putmulti(self, c, data, append):
+        if append:
+            data = iter(data)
+            first = next(data, None)
+            if first is None: return 0
+            
+            append = not c.last() or first[0] > c.key()
+            data = itertools.chain((first, ), data)
+        
+        if not append:
+            consumed, _added = c.putmulti(data)
+            return consumed
+        
+        # LMDB skips appends that are out of order without complaint so they are
+        # held back and written normally afterwards
+        late = []
+        consumed, added = c.putmulti(_in_order(data, late), append=True)
+        if added != consumed:
+            raise RuntimeError("Appended %d of %d items" % (added, consumed))
+        
+        if late:
+            consumed += c.putmulti(late)[0]
         return consumed
-
+    
     def iter_get(self, keys, end_revision=None, start_revision=None):
         '''
         Generator that yields three tuples of (key, packed_revision, value) for every
         key in `keys`.  Keys *must* be naturally sorted.
         '''
-        last = self.revision_packer.pack(start_revision or 0)
-        first= self.revision_packer.pack(end_revision or self.revision_packer.max)
+        # revisions are inverted
+        last = self.revision_packer.max - (start_revision or 0)
+        first = self.revision_packer.pack(end_revision or self.revision_packer.max)
         
         logger.debug("RANGE: %r -> %r", first, last)
         
-        with self.env.begin() as txn:
-            with txn.cursor() as c:
-                for key in keys:
-                    logger.debug("SET_RANGE: %r", key+first)
-                    if c.set_range(key + first):
-                        k, v = c.item()
-                        k, r = k[:-4], k[-4:]
-                        logger.debug("ITEM %r %r %r", k, r, v)
-                        
-                        if k != key or r > last: 
-                            r = v = None
-                    else:
-                        logger.debug("get_item(%r, %r, %r): item not found", key, end_revision, start_revision)
-                        r = v = None
-                    yield key, r, v
-                
-        logger.debug("get_item(%r, %r, %r): %r => %r [%r]", key, end_revision, start_revision, k, r, v)
-        
+        with self.seek_cursor() as c:
+            for key in keys:
+                logger.debug("SET_RANGE: %r", key+first)
+                if c.set_range(key + first) and self._match(c.key(), key, last):
+                    k, v = c.item()
+                    r = k[-4:]
+                    if self.buffers: v = str(v)
+                else:
+                    logger.debug("get_item(%r, %r, %r): item not found", key, end_revision, start_revision)
+                    r = v = None
+                yield key, r, v
         
-
     def get_item(self, key, end_revision=None, start_revision=None):
         '''
         Returns two tuple of (packed revision, value) or None
         '''
         
         # revisions are inverted
-        last = self.revision_packer.pack(start_revision or 0)
-        first= self.revision_packer.pack(end_revision or self.revision_packer.max)
+        last = self.revision_packer.max - (start_revision or 0)
+        first = self.revision_packer.pack(end_revision or self.revision_packer.max)
         
         #logger.debug("RANGE: %r -> %r", first, last)
         
-        with self.env.begin() as txn:
-            with txn.cursor() as c:
-                #logger.debug("SET_RANGE: %r", key + first)
-                if not c.set_range(key + first):
-                    #logger.debug("get_item(%r, %r, %r): item not found", key, end_revision, start_revision)
-                    raise KeyError("Key not found")
+        with self.seek_cursor() as c:
+            #logger.debug("SET_RANGE: %r", key + first)
+            if not c.set_range(key + first) or not self._match(c.key(), key, last):
+                #logger.debug("get_item(%r, %r, %r): item not found", key, end_revision, start_revision)
+                raise KeyError("Key not found")
+            
+            k, v = c.item()
+            if self.buffers: v = str(v)
+        
+        #logger.debug("get_item(%r, %r, %r): %r => %r [%r]", key, end_revision, start_revision, k, r, v)
                 
-                k, v = c.item()
+        return k[-4:], v
+    
+    def get_value(self, key, unpack, end_revision=None, start_revision=None):
+        '''
+        As get_item() but the value is passed through unpack, or is None if the key
+        has been deleted.  Packed values are served from and kept in the cache if there
+        is one, and unpacked on every read so callers each get their own copy.
+        '''
+        # reads of the latest revision could race with a store so aren't cached
+        if self.cache is None or end_revision is None:
+            return _get_value(self, key, unpack, end_revision, start_revision)
         
-        k, r = k[:-4], k[-4:]
+        cache_key = (self.env, key)
+        revision = end_revision
         
-        #logger.debug("get_item(%r, %r, %r): %r => %r [%r]", key, end_revision, start_revision, k, r, v)
+        hit = self.cache.get(cache_key, revision, start_revision or 0)
+        if hit is not None:
+            r, v = hit
+        else:
+            r, v = self.get_item(key, end_revision, start_revision)
+            first = self.unpack_revision(r)
+            
+            entry = self.cache.peek(cache_key)
+            if entry is not None and entry[0] == first:
+                # same value, now known to be current up to revision
+                revision = max(revision, entry[1])
+            
+            self.cache.put(cache_key, first, revision, r, v)
         
-        if k != key or r > last:
-            raise KeyError("Key not found")
-                
-        return r, v
+        return r, None if is_deleted(v) else unpack(v)
 
     def iter_items(self, start_key=None, end_key=None, end_revision=None, start_revision=None):
         '''
@@ -118,48 +247,52 @@ class RevisionDataStore(object):
         and `key < end_key`.
         '''
         
-        last = self.revision_packer.pack(start_revision or 0)
-        first = self.revision_packer.pack(end_revision or self.revision_packer.max)
+        # revisions are inverted
+        last = self.revision_packer.max - (start_revision or 0)
+        first = self.revision_packer.max - (end_revision or self.revision_packer.max)
+        packed_first = self.revision_packer.pack(end_revision or self.revision_packer.max)
         
         #logger.debug("ITER_ITEMS %r - %r", first, last)
         
-        with self.env.begin() as txn:
-            with txn.cursor() as c:
-                if start_key:
-                    if not c.set_range(start_key):
-                        #logger.debug("No matches")
-                        return
-                else:
-                    c.first()
+        with self.read_cursor(self.buffers) as c:
+            found = c.set_range(start_key) if start_key else c.first()
+            key = c.key() if found else None
+            probe = 0
+            
+            while key is not None:
+                k = key[:-4]
+                #logger.debug("KEY: %r", key)
                 
-                while True:
-                    key = c.key()
-                    #logger.debug("KEY: %r", key)
-                    
-                    if key[-4:] < first: # out of range - jump to next
-                        #logger.debug("SKIPPING TO %r", key[:-4] + first)
-                        if not c.set_range(key[:-4] + first):
-                            break
-                        new_key = c.key()
-                        if new_key[:-4] > key[:-4]:
-                            #logger.debug("No valid key for this commit %r > %r", new_key[:-4], key[:-4])
-                            continue
-                        key = new_key
-                    #logger.debug("NEW KEY: %r", key)
-                        
-                    if end_key and key > end_key: break
-                    
-                    k, r = key[:-4], key[-4:]
-                    
-                    # if in range then yield
-                    if r <= last:
-                        #logger.debug("YIELD: %r %r %r", k, r, c.value())
-                        yield k, r, c.value()
-                    
-                    # seek to next item
-                    #logger.debug("SEEK: %r", k+'\xFF\xFF\xFF\xFF')
-                    if not c.set_range(k + '\xFF\xFF\xFF\xFF'):
-                        break
+                if end_key and k >= end_key: break
+                
+                r = self.revision_at(key)
+                
+                if r < first: # out of range - jump to next
+                    #logger.debug("SKIPPING TO %r", k + packed_first)
+                    key = c.key() if c.set_range(k + packed_first) else None
+                    if key is None or key[:-4] != k:
+                        #logger.debug("No valid key for this commit %r", k)
+                        continue
+                    r = self.revision_at(key)
+                #logger.debug("NEW KEY: %r", key)
+                
+                # if in range then yield
+                if r <= last:
+                    #logger.debug("YIELD: %r %r %r", k, r, c.value())
+                    yield k, key[-4:], c.value()
+                
+                # the next record is usually the next key so just step to it - if it is an
+                # older revision seek past them and keep seeking for the next `seek_run` keys
+                if probe:
+                    probe -= 1
+                elif self.step_keys:
+                    key = c.key() if c.next() else None
+                    if key is None or key[:-4] != k: continue
+                    probe = self.seek_run
+                
+                # seek to next item
+                #logger.debug("SEEK: %r", k+'\xFF\xFF\xFF\xFF')
+                key = c.key() if c.set_range(k + '\xFF\xFF\xFF\xFF') else None
             
     def stat(self):
         return self.env.stat()
@@ -172,48 +305,170 @@ class RevisionDataStore(object):
         first = self.revision_packer.pack(end_revision or self.revision_packer.max)
         last = self.revision_packer.pack(start_revision or 0)
         
-        with self.env.begin() as txn:
-            with txn.cursor() as c:
-                
-                if not c.set_range(key + first):
-                    return
-                
-                final_key = key + last
-                
+        with self.read_cursor() as c:
+            
+            if not c.set_range(key + first):
+                return
+            
+            final_key = key + last
+            
+            k, v = c.item()
+            while k < final_key:
+                yield self.revision_packer.extract_last(k)[1], v
+                c.next()
                 k, v = c.item()
-                while k < final_key:
-                    yield self.revision_packer.extract_last(k)[1], v
-                    c.next()
-                    k, v = c.item()
                     
-    def iter_prune(self, keep=2):
+    def iter_prune(self, keep=2, start_key=None, end_key=None, before_revision=None):
+        '''
+        Removes all but the last `keep` revisions of each key between start_key and end_key
+        (exclusive), yielding (key, revision, value) for each revision removed.  With
+        before_revision only revisions older than it are removed.
+        Runs in a single write transaction.
+        '''
+        
+        # pruned revisions could still be in the cache
+        if self.cache is not None:
+            self.cache.clear()
         
         with self.env.begin(write=True) as txn:
             with txn.cursor() as c:
                 current_key = None
                 key_count = 0
                 
-                c.first()
+                if not (c.set_range(start_key) if start_key else c.first()):
+                    return
                 
                 while True:
                     kr, v = c.item()
+                    if not kr: break # deleted the last record
                     k, r = self.revision_packer.extract_last(kr)
                     
+                    if end_key is not None and k >= end_key: break
+                    
                     if k != current_key:
                         current_key = k
                         key_count = 0
                         
                     key_count += 1
-                    if key_count > keep:
+                    if key_count > keep and (before_revision is None or r < before_revision):
                         yield k, r, v
                         if not c.delete(): break
                     else:
                         if not c.next(): break
                         
+    def prune_batch(self, keep=2, start_key=None, batch_size=1000, before_revision=None):
+        '''
+        Prunes (as iter_prune) the next batch_size keys from start_key in one write transaction.
+        Returns (revisions removed, key to start the next batch from or None if finished)
+        '''
+        keys = list(self.iter_keys(start_key, batch_size + 1))
+        end_key = keys[batch_size] if len(keys) > batch_size else None
+        
+        pruned = 0
+        for _item in self.iter_prune(keep, start_key, end_key, before_revision):
+            pruned += 1
+        return pruned, end_key
+                        
+    def prune(self, keep=2, batch_size=1000, before_revision=None):
+        '''
+        Removes all but the last `keep` revisions of each key, using a separate write
+        transaction for every batch_size keys.  Returns the number of revisions removed.
+        '''
+        pruned = 0
+        start_key = None
+        while True:
+            n, start_key = self.prune_batch(keep, start_key, batch_size, before_revision)
+            pruned += n
+            if start_key is None:
+                return pruned
     
-    def iter_revisions(self, end_revision=None, start_revision=None):
+    def iter_vacuum(self, before_revision, start_key=None, end_key=None, tombstone=is_deleted):
         '''
-        Generator yielding (key, packed revision, value)
+        Removes the revisions of each key between start_key and end_key (exclusive)
+        that no read at before_revision or later can see - everything older than the
+        newest revision at or before it, and that one too if `tombstone(value)` is
+        true.  Yields (key, revision, value) for each revision removed.
+        Runs in a single write transaction.
+        '''
+        if self.cache is not None:
+            self.cache.clear()
+
+        with self.env.begin(write=True) as txn:
+            with txn.cursor() as c:
+                current_key = None
+                seen = False
+
+                if not (c.set_range(start_key) if start_key else c.first()):
+                    return
+
+                while True:
+                    kr, v = c.item()
+                    if not kr: break # deleted the last record
+                    k, r = self.revision_packer.extract_last(kr)
+
+                    if end_key is not None and k >= end_key: break
+
+                    if k != current_key:
+                        current_key = k
+                        seen = False
+
+                    if r > before_revision:
+                        remove = False
+                    elif seen:
+                        remove = True
+                    else:
+                        # what a read at before_revision finds
+                        seen = True
+                        remove = tombstone(v)
+
+                    if remove:
+                        yield k, r, v
+                        if not c.delete(): break
+                    else:
+                        if not c.next(): break
+
+    def vacuum_batch(self, before_revision, start_key=None, batch_size=1000, tombstone=is_deleted):
+        '''
+        Vacuums (as iter_vacuum) the next batch_size keys from start_key in one write transaction.
+        Returns (revisions removed, key to start the next batch from or None if finished)
+        '''
+        keys = list(self.iter_keys(start_key, batch_size + 1))
+        end_key = keys[batch_size] if len(keys) > batch_size else None
+
+        removed = 0
+        for _item in self.iter_vacuum(before_revision, start_key, end_key, tombstone):
+            removed += 1
+        return removed, end_key
+
+    def vacuum(self, before_revision, batch_size=1000, tombstone=is_deleted):
+        '''
+        Removes the revisions no read at before_revision or later can see, using a
+        separate write transaction for every batch_size keys.  Returns the number of
+        revisions removed.
+        '''
+        removed = 0
+        start_key = None
+        while True:
+            n, start_key = self.vacuum_batch(before_revision, start_key, batch_size, tombstone)
+            removed += n
+            if start_key is None:
+                return removed
+
+    def iter_keys(self, start_key=None, limit=None):
+        ' Generator yielding each distinct key from start_key '
+        count = 0
+        with self.read_cursor() as c:
+            if not (c.set_range(start_key) if start_key else c.first()): return
+            while limit is None or count < limit:
+                k = c.key()[:-4]
+                yield k
+                count += 1
+                if not c.set_range(k + '\xFF' * 4): break
+    
+    def iter_revisions(self, end_revision=None, start_revision=None, start_key=None, end_key=None):
+        '''
+        Generator yielding (key, packed revision, value) for keys from start_key up to
+        end_key (exclusive)
         '''
         
         first = self.revision_packer.pack(end_revision or self.revision_packer.max)
@@ -221,12 +476,14 @@ class RevisionDataStore(object):
         
         logger.debug("RANGE: %r => %r", first, last)
         
-        with self.env.begin() as txn:
-            with txn.cursor() as c:
-                for k, v in iter(c):
-                    k, r = k[:-4], k[-4:]
-                    if r < last and r >= first:
-                        yield k, r, v
+        with self.read_cursor() as c:
+            if start_key and not c.set_range(start_key): return
+            
+            for k, v in iter(c):
+                k, r = k[:-4], k[-4:]
+                if end_key is not None and k >= end_key: break
+                if r < last and r >= first:
+                    yield k, r, v
     
     def dump(self):
         print "=== ENV: %s ===", self.env.path()
@@ -276,19 +533,164 @@ class MemoryDataStore(SortedDict):
     def iter_revisions(self, end_revision=None, start_revision=None):
         return self.iter_items()
         
+class ScratchDataStore(object):
+    '''
+    Unrevisioned key => value datastore on a driver database.  Like `MemoryDataStore`
+    it represents a single revision.
+    '''
+    
+    current_revision = MemoryDataStore.current_revision
+    
+    def __init__(self, env):
+        self.env = env
+        
+    def store(self, data, revision=None):
+        with self.env.begin(write=True) as txn:
+            with txn.cursor() as c:
+                c.putmulti(data)
+                
+    def get_item(self, key, end_revision=None, start_revision=None):
+        with self.env.begin() as txn:
+            with txn.cursor() as c:
+                if c.set_range(key) and c.key() == key:
+                    return self.current_revision, c.value()
+        raise KeyError("Key not found")
+    
+    def iter_get(self, keys, end_revision=None, start_revision=None):
+        with self.env.begin() as txn:
+            with txn.cursor() as c:
+                for key in keys:
+                    if c.set_range(key) and c.key() == key:
+                        yield key, self.current_revision, c.value()
+                    else:
+                        yield key, None, None
+    
+    def iter_items(self, start_key=None, end_key=None, end_revision=None, start_revision=None):
+        with self.env.begin() as txn:
+            with txn.cursor() as c:
+                found = c.set_range(start_key) if start_key else c.first()
+                
+                while found:
+                    k = c.key()
+                    if end_key is not None and k >= end_key: break
+                    
+                    yield k, self.current_revision, c.value()
+                    found = c.next()
+                    
+class BufferDataStore(object):
+    '''
+    Write buffer for a transaction.  Behaves as a `MemoryDataStore` until it holds more
+    than `max_size` bytes of keys and values, then the contents are spilled to a
+    `ScratchDataStore` on a driver scratch database and reads are merged across both.
+    
+    `max_size` of None, or a driver without scratch databases, never spills.  Call
+    `close()` to remove any scratch database.
+    '''
+    
+    current_revision = MemoryDataStore.current_revision
+    
+    def __init__(self, driver, max_size=None):
+        self.driver = driver
+        self.max_size = max_size
+        self.memory = MemoryDataStore()
+        self.size = 0
+        self.scratch = None
+        self._ds = self.memory
+        
+    def store(self, data, revision=None):
+        data = list(data)
+        self.memory.store(data, revision)
+        
+        if self.max_size is None: return
+        
+        self.size += sum( len(k) + len(v) for k, v in data )
+        if self.size > self.max_size:
+            self.spill()
+            
+    def spill(self):
+        if self.scratch is None:
+            env = self.driver.scratch()
+            if env is None:
+                logger.debug("Driver has no scratch databases - keeping %d bytes in memory", self.size)
+                self.max_size = None
+                return
+            
+            self.scratch = ScratchDataStore(env)
+            self._ds = ProxyDataStore((self.memory, self.scratch))
+            
+        logger.debug("Spilling %d bytes to scratch", self.size)
+        self.scratch.store(self.memory.iteritems())
+        self.memory.clear()
+        self.size = 0
+        
+    def get_item(self, key, end_revision=None, start_revision=None):
+        return self._ds.get_item(key, end_revision, start_revision)
+    
+    def iter_get(self, keys, end_revision=None, start_revision=None):
+        return self._ds.iter_get(keys, end_revision, start_revision)
+    
+    def iter_items(self, start_key=None, end_key=None, end_revision=None, start_revision=None):
+        return self._ds.iter_items(start_key, end_key, end_revision, start_revision)
+    
+    def iteritems(self):
+        ' (key, value) for everything in the buffer in key order '
+        if self.scratch is None:
+            return self.memory.iteritems()
+        return ( (k, v) for k, _r, v in self._ds.iter_items() )
+    
+    def close(self):
+        if self.scratch is not None:
+            self.scratch.env.drop()
+            self.scratch = None
+        self.memory.clear()
+        self.size = 0
+        self._ds = self.memory
+        
 class ArchiveDataStore(RevisionDataStore):
     '''
-    Extension of RevisionDataStore but stores actual data in a zip archive.
+    Extension of RevisionDataStore but stores actual data in a block archive.
+    
+    Values are appended in the order they are received into blocks of roughly
+    block_size bytes which are zlib compressed and written to the archive file.
+    The LMDB values hold the location of each value (block offset, block size,
+    offset and length within the block) so a read is a slice of the memory mapped
+    archive and a single block decompress.  The most recently decompressed block
+    is kept so that sorted scans decompress each block only once.
+    
+    A bloom filter of the archived keys is saved beside the archive so that a
+    ProxyDataStore can skip archives which cannot contain a key.  New keys are
+    added to it as they are archived and it is only rebuilt, at twice the size,
+    once it is full.
     '''
     
-    def __init__(self, env, archive, current_commit):
+    # block offset, compressed block size, value offset, value length
+    location_packer = struct.Struct('>QIII')
+    
+    bloom_error_rate = 0.001
+    bloom_capacity = 1024
+    
+    def __init__(self, env, archive, current_commit, block_size=65536, compress_level=6, index_blocks=64):
         self._archive = archive
+        self.block_size = block_size
+        self.index_blocks = index_blocks
+        self.compress_level = compress_level
+        self._fp = None
+        self._map = None
+        self._block = (None, None)
+        self.bloom = utils.BloomFilter.load(archive + '.bloom') if os.path.exists(archive + '.bloom') else None
         super(ArchiveDataStore, self).__init__(env, current_commit)
         
-    def store(self, data, revision):
+    def might_contain(self, key):
+        '''
+        False if the key is definitely not in this archive.  Archives without a bloom
+        filter might contain anything.
+        '''
+        return self.bloom is None or key in self.bloom
+        
+    def store(self, data, revision, txn=None, append=False):
         self.archive(( (k, self.revision_packer.pack(revision), v) for k, v in data ))
             
-    def archive(self, data):
+    def archive(self, data, processes=None):
         '''
         Adds the items from the supplied iterable to the archive.
         Can take the the following iterators without modification:
@@ -298,26 +700,143 @@ class ArchiveDataStore(RevisionDataStore):
         * iter_revisions()
         
         Alternatively can take any iterable that yields (key, packed_revision, value)
+        
+        If processes is given blocks are compressed by a pool of that many worker
+        processes while this process carries on reading and writing.  The index is
+        committed every index_blocks blocks so other writers to the environment are
+        not held up for the whole run.
         '''
-        with self.env.begin(write=True) as txn:
-            with zipfile.ZipFile(self._archive, 'a') as zf:
-                for k, r, v in data:
-                    filename = base64.b64encode(k + r)
-                    zf.writestr(filename, v)
-                    txn.put(k + r, filename)
+        if self.bloom is None and not self._entries():
+            self.bloom = utils.BloomFilter(self.bloom_capacity, self.bloom_error_rate)
+        
+        blocks = self.iter_blocks(data)
+        
+        pool = multiprocessing.Pool(processes) if processes else None
+        try:
+            if pool is None:
+                compressed = ( (pending, zlib.compress(raw, self.compress_level)) for pending, raw in blocks )
+            else:
+                compressed = _compress_blocks(pool, blocks, self.compress_level, processes * 2)
+                
+            with open(self._archive, 'ab') as fp:
+                fp.seek(0, 2)
+                
+                while True:
+                    group = list(itertools.islice(compressed, self.index_blocks))
+                    if not group: break
+                    
+                    with self.env.begin(write=True) as txn:
+                        for pending, block in group:
+                            self._write_block(fp, txn, pending, block)
+                        # blocks must be on disk before the index points at them
+                        fp.flush()
+            
+            if pool is not None:
+                pool.close()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        
+        # the archive has grown so needs remapping
+        self.close()
+        
+        if self.bloom is None:
+            self.build_bloom()
+        else:
+            self.bloom.save(self._archive + '.bloom')
+        
+    def iter_blocks(self, data):
+        '''
+        Groups (key, packed_revision, value) items into uncompressed blocks, yielding
+        ([(btkey, offset, length), ...], block)
+        '''
+        pending = []
+        values = []
+        size = 0
+        for k, r, v in data:
+            if v is None: continue # iter_get() misses
+            v = str(v)
+            
+            pending.append((k + r, size, len(v)))
+            values.append(v)
+            size += len(v)
+            
+            if size >= self.block_size:
+                yield pending, ''.join(values)
+                pending = []
+                values = []
+                size = 0
+                
+        if pending:
+            yield pending, ''.join(values)
+                
+    def _write_block(self, fp, txn, pending, block):
+        offset = fp.tell()
+        fp.write(block)
+        
+        for k, o, length in pending:
+            txn.put(k, self.location_packer.pack(offset, len(block), o, length))
+            self._bloom_add(k[:-4])
+            
+    def _bloom_add(self, key):
+        if self.bloom is None: return
+        
+        if self.bloom.full():
+            # rebuilt once the archive is written - meanwhile anything might be here
+            self.bloom = None
+        else:
+            self.bloom.add(key)
+        
+    def _entries(self):
+        with self.env.begin() as txn:
+            return txn.stat(self.env.db)['entries']
+        
+    def build_bloom(self, error_rate=None):
+        '''
+        Rebuilds the bloom filter from every key in the archive, with room for as many
+        again, and saves it beside the archive file.
+        '''
+        capacity = max(self._entries() * 2, self.bloom_capacity)
+        
+        bloom = utils.BloomFilter(capacity, error_rate or self.bloom_error_rate)
+        with self.read_cursor() as c:
+            for btkey in c.iternext(values=False):
+                bloom.add(btkey[:-4])
+        
+        bloom.save(self._archive + '.bloom')
+        self.bloom = bloom
+                    
+    def read(self, location):
+        ' Returns the data for a packed location '
+        offset, size, start, length = self.location_packer.unpack(location)
+        
+        if self._block[0] != offset:
+            if self._map is None:
+                self._fp = open(self._archive, 'rb')
+                self._map = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+            
+            self._block = (offset, zlib.decompress(self._map[offset:offset + size]))
+        
+        return self._block[1][start:start + length]
+    
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._fp.close()
+            self._map = self._fp = None
+        self._block = (None, None)
                 
     def get_item(self, key, end_revision=None, start_revision=None):
-        r, filename = super(ArchiveDataStore, self).get_item(key, end_revision, start_revision)
-        with zipfile.ZipFile(self._archive, 'r') as zf:
-            return r, zf.read(filename)
+        r, location = super(ArchiveDataStore, self).get_item(key, end_revision, start_revision)
+        return r, self.read(location)
     
     def iter_extract(self, i):
-        with zipfile.ZipFile(self._archive, 'a') as zf:
-            for d in i:
-                if d[-1] is None:
-                    yield d
-                else:
-                    yield d[:-1] + (zf.read(d[-1]), )
+        for d in i:
+            if d[-1] is None:
+                yield d
+            else:
+                yield d[:-1] + (self.read(d[-1]), )
     
     def iter_get(self, keys, end_revision=None, start_revision=None):
         return self.iter_extract(super(ArchiveDataStore, self).iter_get(keys, end_revision, start_revision))
@@ -325,14 +844,76 @@ class ArchiveDataStore(RevisionDataStore):
     def iter_items(self, start_key=None, end_key=None, end_revision=None, start_revision=None):
         return self.iter_extract(super(ArchiveDataStore, self).iter_items(start_key, end_key, end_revision, start_revision))
     
-    def iter_prune(self, keep=2):
-        return self.iter_extract(super(ArchiveDataStore, self).iter_prune(keep))
+    def iter_prune(self, keep=2, start_key=None, end_key=None, before_revision=None):
+        return self.iter_extract(super(ArchiveDataStore, self).iter_prune(keep, start_key, end_key, before_revision))
+    
+    def iter_vacuum(self, before_revision, start_key=None, end_key=None, tombstone=is_deleted):
+        return self.iter_extract(super(ArchiveDataStore, self).iter_vacuum(before_revision, start_key, end_key,
+                                                                            lambda location: tombstone(self.read(location))))
     
     def iter_history(self, key, end_revision=None, start_revision=None):
         return self.iter_extract(super(ArchiveDataStore, self).iter_history(key, end_revision, start_revision))
     
-    def iter_revisions(self, end_revision=None, start_revision=None):
-        return self.iter_extract(super(ArchiveDataStore, self).iter_revisions(end_revision, start_revision))
+    def iter_revisions(self, end_revision=None, start_revision=None, start_key=None, end_key=None):
+        return self.iter_extract(super(ArchiveDataStore, self).iter_revisions(end_revision, start_revision, start_key, end_key))
+
+def _compress_blocks(pool, blocks, level, ahead):
+    '''
+    Compresses (pending, block) pairs in the pool, yielding them in order.  At most
+    `ahead` blocks are in flight so the source is only read as fast as it is written.
+    '''
+    results = collections.deque()
+    for pending, raw in blocks:
+        results.append((pending, pool.apply_async(zlib.compress, (raw, level))))
+        if len(results) >= ahead:
+            pending, result = results.popleft()
+            yield pending, result.get()
+            
+    while results:
+        pending, result = results.popleft()
+        yield pending, result.get()
+
+def compact(source, archive, keep=None, processes=None, batch_size=1000):
+    '''
+    Streams every revision from the source RevisionDataStore into the archive, compressing
+    in `processes` worker processes, then prunes the source to `keep` revisions per key
+    in batches of batch_size keys.  Give the source a snapshot to archive a consistent view
+    while commits continue.
+    
+    Returns the number of revisions pruned.
+    '''
+    archive.archive(source.iter_revisions(), processes)
+    
+    if keep is None:
+        return 0
+    return source.prune(keep, batch_size)
+
+def _get_value(ds, key, unpack, end_revision=None, start_revision=None):
+    r, v = ds.get_item(key, end_revision, start_revision)
+    return r, None if v is None or is_deleted(v) else unpack(v)
+
+def get_value(ds, key, unpack, end_revision=None, start_revision=None):
+    '''
+    Returns (packed revision, unpacked value) for key from any datastore, using its
+    `get_value()` if it has one.  The value is None if the key has been deleted.
+    Raises KeyError if the key is not found.
+    '''
+    if hasattr(ds, 'get_value'):
+        return ds.get_value(key, unpack, end_revision, start_revision)
+    return _get_value(ds, key, unpack, end_revision, start_revision)
+
+def _might_contain(ds, key):
+    return not hasattr(ds, 'might_contain') or ds.might_contain(key)
+
+def _in_order(data, late):
+    ' passes on items while their keys increase, adding any others to late '
+    last = None
+    for k, v in data:
+        if last is not None and k <= last:
+            late.append((k, v))
+            continue
+        last = k
+        yield k, v
 
 class ProxyDataStore(object):
     '''
@@ -355,60 +936,97 @@ class ProxyDataStore(object):
     
     def get_item(self, key, end_revision=None, start_revision=None):
         '''
-        Returns the value from the first DataStore that doesn't raise a KeyError
+        Returns the value from the first DataStore that doesn't raise a KeyError.
+        DataStores with a `might_contain` method (e.g. ArchiveDataStore) are skipped
+        if they cannot hold the key.
         '''
         for ds in self.datastores:
+            if not _might_contain(ds, key): continue
             try:
                 return ds.get_item(key, end_revision, start_revision)
             except KeyError:
                 pass
         raise KeyError("Key not found in any datastore")
     
+    def get_value(self, key, unpack, end_revision=None, start_revision=None):
+        ' As get_item() but the value is unpacked - see `get_value()` '
+        for ds in self.datastores:
+            if not _might_contain(ds, key): continue
+            try:
+                return get_value(ds, key, unpack, end_revision, start_revision)
+            except KeyError:
+                pass
+        raise KeyError("Key not found in any datastore")
+    
     def iter_items(self, start_key=None, end_key=None, end_revision=None, start_revision=None):
         '''
         Creates an iterator pool and yields (key, packed_revision, value) for the highest revision of
         each item (within the start_revision and end_revision bounds) between the specified keys.
         '''
         
-        # key, revision, value iterator
-        items = [ ( None, None, None, ds.iter_items(start_key, end_key, end_revision, start_revision)) for ds in self.datastores ]
+        iterators = [ ds.iter_items(start_key, end_key, end_revision, start_revision) for ds in self.datastores ]
         
-        while items:
-            # find the lowest one and yield it
-            lk, r, v, i = min(items)
-            if lk is not None:
-                yield lk, r, v
-            
-            new_items = []
-            for k, r, v, i in items:
-                try:
-                    if k == lk:
-                        new_items.append(i.next() + (i, ))
-                    else:
-                        new_items.append((k, r, v, i))
-                except StopIteration:
-                    pass
+        # (key, priority, revision, value) - priorities are unique so values never get compared
+        # and the first datastore wins when keys tie
+        heap = []
+        for priority, i in enumerate(iterators):
+            item = next(i, None)
+            if item is not None:
+                heap.append((item[0], priority) + item[1:])
+        heapq.heapify(heap)
+        
+        while heap:
+            k, _p, r, v = heap[0]
+            yield k, r, v
             
-            items = new_items
+            # move on every iterator sitting on this key
+            while heap and heap[0][0] == k:
+                priority = heap[0][1]
+                item = next(iterators[priority], None)
+                if item is None:
+                    heapq.heappop(heap)
+                else:
+                    heapq.heapreplace(heap, (item[0], priority) + item[1:])
             
-    def iter_get(self, keys, end_revision=None, start_revision=None):
+    def iter_get(self, keys, end_revision=None, start_revision=None, batch_size=1000):
         '''
-        Creates an iterator pool and yields (key, packed_revision, value) for the highest revision of
-        each item (within the start_revision and end_revision_bounds) for each key in keys.
+        Yields (key, packed_revision, value) for the highest revision of each item (within the
+        start_revision and end_revision bounds) for each key in keys.  Keys *must* be naturally sorted.
+        
+        Keys are taken in batches and each batch is streamed through the `iter_get` of each
+        datastore in turn, passing on only the keys not yet found, so every datastore
+        walks one cursor per batch.
         
         If the key does not exist in any revision then yields (key, None, None).
         '''
-        for key in keys:
-            found = False
-            for ds in self.datastores:
-                try:
-                    yield (key, ) + ds.get_item(key, end_revision, start_revision)
-                    found = True
-                    break
-                except KeyError:
-                    pass
-            if not found:
-                yield key, None, None
-
+        keys = iter(keys)
         
-        
\ No newline at end of file
+        while True:
+            batch = list(itertools.islice(keys, batch_size))
+            if not batch: break
+            
+            found = {}
+            missing = batch
+            for ds in self.datastores:
+                if not missing: break
+                
+                skipped = []
+                if hasattr(ds, 'might_contain'):
+                    candidates = []
+                    for k in missing:
+                        (candidates if ds.might_contain(k) else skipped).append(k)
+                    missing = candidates
+                
+                remaining = []
+                for k, r, v in ds.iter_get(missing, end_revision, start_revision):
+                    if r is None:
+                        remaining.append(k)
+                    else:
+                        found[k] = r, v
+                
+                # both are sorted
+                missing = list(heapq.merge(skipped, remaining)) if skipped else remaining
+            
+            for key in batch:
+                r, v = found.get(key, (None, None))
+                yield key, r, v
@@ -1,4 +1,8 @@
+import atexit
 import os.path
+import shutil
+import tempfile
+import threading
 
 import logging
 logger = logging.getLogger(__name__)
@@ -15,6 +19,23 @@ try:
     HAS_BSDDB = True
 except ImportError: HAS_BSDDB = False
     
+# scratch directories not yet dropped, removed at exit if a transaction never finished
+_scratch_dirs = set()
+
+@atexit.register
+def _remove_scratch_dirs():
+    for path in list(_scratch_dirs):
+        shutil.rmtree(path, True)
+    _scratch_dirs.clear()
+
+def _scratch_dir():
+    path = tempfile.mkdtemp(prefix='reprisedb-scratch-')
+    _scratch_dirs.add(path)
+    return path
+
+def _remove_scratch_dir(path):
+    shutil.rmtree(path, True)
+    _scratch_dirs.discard(path)
 
 class BaseDriver(object):
     
@@ -27,23 +48,61 @@ class BaseDriver(object):
             os.makedirs(self.path, 0700)
             
         self.dbs = {}
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def begin(self, write=False):
+        '''
+        Transaction spanning all databases from this driver.  Yields None
+        if the backend can't do this, in which case each database will
+        open its own transaction.
+        '''
+        yield None
+        
+    def snapshot(self):
+        '''
+        Long lived read transaction that datastores can share.  None if the
+        backend doesn't support them.
+        '''
+        return None
+    
+    def version(self):
+        '''
+        Value that changes whenever any process writes to the databases, or None if
+        the backend can't be shared between processes.
+        '''
+        return None
+    
+    def scratch(self):
+        '''
+        Private throwaway database outside of the data directory for spilling
+        data to disk, or None if the backend can't provide one.  Call `drop()` on
+        it when finished - it is also dropped when garbage collected or at exit.
+        '''
+        return None
         
     def get_db(self, name):
-        if not name in self.dbs:
-            self.dbs[name] = self.open_db(name)
+        db = self.dbs.get(name)
         
-        return self.dbs[name]
+        if db is None:
+            with self._lock:
+                if not name in self.dbs:
+                    self.dbs[name] = self.open_db(name)
+                db = self.dbs[name]
+        
+        return db
     
     def drop_db(self, name):
         
-        if name in self.dbs:
-            self.dbs[name].close()
-            del self.dbs[name]
-        
-        filename = os.path.join(self.path, name)
-        if os.path.exists(filename):
-            os.unlink(filename)
-            logger.debug("Removed %s", filename)
+        with self._lock:
+            if name in self.dbs:
+                self.dbs[name].close()
+                del self.dbs[name]
+            
+            filename = os.path.join(self.path, name)
+            if os.path.exists(filename):
+                os.unlink(filename)
+                logger.debug("Removed %s", filename)
             
         return True
 
@@ -62,11 +121,29 @@ class LMDBDriver(BaseDriver):
     
     def open_db(self, name):
         return LMDBDatabase(self.env, self.env.open_db(name))
+    
+    def begin(self, **opts):
+        return self.env.begin(**opts)
+    
+    def snapshot(self):
+        return LMDBSnapshot(self.env.begin())
+    
+    def version(self):
+        # id of the snapshot a read would see - the meta page in env.info() can
+        # be ahead of it while another process is committing
+        with self.env.begin() as txn:
+            return txn.id()
+    
+    def scratch(self):
+        return LMDBScratchDatabase(self.env.info()['map_size'])
         
     def drop_db(self, name):
-        with self.env.begin(write=True) as txn:
-            txn.drop_db(name, True)
-        del self.dbs[name]
+        db = self.get_db(name)
+        
+        with self._lock:
+            with self.env.begin(write=True) as txn:
+                txn.drop(db.db, delete=True)
+            self.dbs.pop(name, None)
             
 class LMDBDatabase(object):
     
@@ -77,17 +154,67 @@ class LMDBDatabase(object):
     def begin(self, **opts):
         return self.env.begin(db=self.db, **opts)
     
+    def cursor(self, txn):
+        ' cursor for this database within a driver level transaction '
+        return txn.cursor(db=self.db)
+    
     def path(self):
         return self.env.path()
     
     def stat(self):
         with self.env.begin(db=self.db) as txn:
             return txn.stat()
+        
+class LMDBScratchDatabase(LMDBDatabase):
+    '''
+    Unsynced environment in a temporary directory - nothing in it needs to
+    survive a crash.
+    '''
+    
+    def __init__(self, map_size):
+        self._path = _scratch_dir()
+        env = lmdb.open(self._path, map_size=map_size, sync=False, metasync=False)
+        super(LMDBScratchDatabase, self).__init__(env, None)
+        
+    def drop(self):
+        if self._path is None: return
+        
+        self.env.close()
+        _remove_scratch_dir(self._path)
+        self._path = None
+        
+    def __del__(self):
+        self.drop()
+
+class LMDBSnapshot(object):
+    '''
+    A read transaction held open across many reads, giving a consistent
+    MVCC view.  Point lookups reuse one cursor per database.
+    '''
+    
+    def __init__(self, txn):
+        self.txn = txn
+        self._cursors = {}
+        
+    def cursor(self, database):
+        ' cached cursor for `database` - callers must not rely on its position '
+        if not database in self._cursors:
+            self._cursors[database] = database.cursor(self.txn)
+        return self._cursors[database]
+    
+    def close(self):
+        for c in self._cursors.itervalues():
+            c.close()
+        self._cursors = {}
+        self.txn.abort()
 
 class BSDDBDriver(BaseDriver):
     
     def open_db(self, name):
         return BSDDBDatabase(os.path.join(self.path, name))
+    
+    def scratch(self):
+        return BSDDBScratchDatabase()
 
 class BSDDBDatabase(object):
     
@@ -109,7 +236,7 @@ class BSDDBDatabase(object):
         return r
         
     @contextmanager
-    def begin(self, write=False):
+    def begin(self, write=False, buffers=False):
         if not os.path.exists(self._path): write=True
         
         mode = 'c' if write else 'r'
@@ -119,6 +246,21 @@ class BSDDBDatabase(object):
         bt.close()
         
         
+class BSDDBScratchDatabase(BSDDBDatabase):
+    
+    def __init__(self):
+        self._dir = _scratch_dir()
+        super(BSDDBScratchDatabase, self).__init__(os.path.join(self._dir, 'scratch'))
+        
+    def drop(self):
+        if self._dir is None: return
+        
+        _remove_scratch_dir(self._dir)
+        self._dir = None
+        
+    def __del__(self):
+        self.drop()
+        
 class BSDDBTransaction(object):
     
     def __init__(self, db):
@@ -144,9 +286,13 @@ class BSDDBCursor(object):
     def item(self):
         return self._key, self._value
         
-    def putmulti(self, d):
-        self.db.update(d)
-        return None, None
+    def putmulti(self, d, append=False):
+        ' (items consumed, items added) like LMDB - order doesn\'t matter to a btree '
+        count = 0
+        for k, v in d:
+            self.db[k] = v
+            count += 1
+        return count, count
     
     def delete(self):
         del self.db[self._key]
@@ -1,6 +1,7 @@
-from . import RepriseDataError, NUL, ONE, DELETED
+from . import RepriseDataError, NUL, ONE, DELETED, is_deleted
 
 from reprisedb import packers # @UnusedImport
+from reprisedb import datastore, utils
 
 import logging
 logger = logging.getLogger(__name__)
@@ -37,7 +38,7 @@ class Entry(BaseEntry):
             return self.value_packer.pack(value)
     
     def from_db_value(self, value):
-        if value == DELETED:
+        if is_deleted(value):
             raise KeyError("Key deleted")
         
         return self.value_packer.unpack(value)
@@ -60,10 +61,11 @@ class BoundEntry(object):
         self.start_commit = start_commit
     
     def get(self, pk):
-        _r, v = self.ds.get_item(self.entry.to_db_key(pk), self.end_commit, self.start_commit)
+        _r, v = datastore.get_value(self.ds, self.entry.to_db_key(pk), self.entry.value_packer.unpack,
+                                    self.end_commit, self.start_commit)
         
         if v is not None:
-            return self.entry.from_db_value(v)
+            return v
         
         raise KeyError("Not found in datastore")
     
@@ -86,19 +88,25 @@ class BoundEntry(object):
                   self.entry.from_db_value(v)) for k, _r, v in self.ds.iter_items(start_key,
                                                                                   end_key,
                                                                                   self.end_commit,
-                                                                                  self.start_commit) if v != DELETED )
+                                                                                  self.start_commit) if not is_deleted(v) )
     
     def iter_keys(self, start_key=None, end_key=None):
+        if start_key is not None: start_key = self.entry.to_db_key(start_key)
+        if end_key is not None: end_key = self.entry.to_db_key(end_key)
+        
         return ( self.entry.from_db_key(k) for k, _r, v in self.ds.iter_items(start_key,
                                                                               end_key,
                                                                               self.end_commit,
-                                                                              self.start_commit) if v != DELETED )
+                                                                              self.start_commit) if not is_deleted(v) )
     
     def iter_values(self, start_key=None, end_key=None):
+        if start_key is not None: start_key = self.entry.to_db_key(start_key)
+        if end_key is not None: end_key = self.entry.to_db_key(end_key)
+        
         return ( self.entry.from_db_value(v) for k, _r, v in self.ds.iter_items(start_key,
                                                                                 end_key,
                                                                                 self.end_commit,
-                                                                                self.start_commit) if v != DELETED )
+                                                                                self.start_commit) if not is_deleted(v) )
         
     def contains(self, pk):
         _r, v = self.ds.get_item(self.entry.to_db_key(pk), self.end_commit, self.start_commit)
@@ -107,6 +115,16 @@ class BoundEntry(object):
         
     def keys(self, start_key=None, end_key=None):
         return list(self.iter_keys(start_key, end_key))
+    
+    def count(self, start_key=None, end_key=None):
+        ' number of keys in the range, without unpacking them '
+        if start_key is not None: start_key = self.entry.to_db_key(start_key)
+        if end_key is not None: end_key = self.entry.to_db_key(end_key)
+        
+        return sum( 1 for _k, _r, v in self.ds.iter_items(start_key,
+                                                          end_key,
+                                                          self.end_commit,
+                                                          self.start_commit) if not is_deleted(v) )
 
 class SimpleIndex(BaseEntry):
     
@@ -131,7 +149,7 @@ class SimpleIndex(BaseEntry):
         value, pk = self.key_packer.extract_last(db_key)
         return value[:-1], pk
     
-    def prepare(self, value, pk, mark):
+    def prepare(self, value, pk, mark, item=None):
         '''
         >>> SimpleIndex(packers.p_uint32, packers.p_string).prepare('Bob', 34, '+')
         ('Bob\\x00\\x00\\x00\\x00\x22', '+')
@@ -140,6 +158,18 @@ class SimpleIndex(BaseEntry):
             raise RepriseDataError("Mark should be one of '+' or '-'")
         return self.to_db_key(value, pk), mark
     
+    def is_tombstone(self, value):
+        ' True for the stored value of a removed entry '
+        return value[0] == '-'
+    
+    def extract(self, item, accessor):
+        ' the value item is indexed under, or None if it is not indexed '
+        return utils.dotted_accessor(item, accessor)
+    
+    def projection_changed(self, new_item, old_item):
+        ' True if the index value needs rewriting even though the indexed value is unchanged '
+        return False
+    
     def key_range(self, start_key, end_key=None):
         '''
         >>> SimpleIndex(packers.p_uint32, packers.p_string).key_range('Boa', 'Bod')
@@ -155,6 +185,164 @@ class SimpleIndex(BaseEntry):
             b = self.value_packer.pack(end_key) + NUL
         
         return a + NUL, b
+    
+    def fields(self, accessor):
+        ' the accessors making up the index value '
+        return [accessor]
+    
+    def pack_prefix(self, values):
+        '''
+        Packed start shared by the keys of every entry whose value begins with values
+        
+        >>> SimpleIndex(packers.p_uint32, packers.p_string).pack_prefix(['Bob'])
+        'Bob\\x00'
+        '''
+        return ''.join( self.value_packer.pack(v, index=True) for v in values )
+
+class CoveringIndex(SimpleIndex):
+    '''
+    Index that also stores a projection of selected fields of the item alongside
+    the mark, so queries that only need those fields can be answered from the
+    index alone.
+    '''
+    
+    def __init__(self, key_packer, value_packer, fields):
+        super(CoveringIndex, self).__init__(key_packer, value_packer)
+        self.fields = list(fields)
+        
+    def project(self, item):
+        '''
+        >>> index = CoveringIndex(packers.p_uint32, packers.p_string, ['age', 'address.city'])
+        >>> sorted(index.project({'age': 32, 'address': {'city': 'Leeds'}}).items())
+        [('address.city', 'Leeds'), ('age', 32)]
+        '''
+        return dict( (f, utils.dotted_accessor(item, f)) for f in self.fields )
+    
+    def prepare(self, value, pk, mark, item=None):
+        '''
+        >>> CoveringIndex(packers.p_uint32, packers.p_string, ['age']).prepare('Bob', 34, '+', {'name': 'Bob', 'age': 32})
+        ('Bob\\x00\\x00\\x00\\x00\x22', '+\\x81\\xa3age ')
+        '''
+        key, mark = super(CoveringIndex, self).prepare(value, pk, mark)
+        
+        if mark == '+':
+            mark += packers.p_obj.pack(self.project(item))
+            
+        return key, mark
+    
+    def from_db_value(self, value):
+        ' projection stored in an index value '
+        return packers.p_obj.unpack(value[1:])
+    
+    def projection_changed(self, new_item, old_item):
+        return self.project(new_item) != self.project(old_item)
+
+class CompoundIndex(SimpleIndex):
+    '''
+    Index on several accessors at once.  Values are tuples packed field by field,
+    so entries sort on the first field then the second and so on.  Lookups give
+    values for the leading fields and can range over the last one given.
+    '''
+    
+    def __init__(self, key_packer, value_packers, accessors):
+        super(CompoundIndex, self).__init__(key_packer, None)
+        self.value_packers = value_packers
+        self.accessors = list(accessors)
+        
+    def __repr__(self):
+        return "<CompoundIndex key={0} values={1}>".format(self.key_packer, self.value_packers)
+        
+    def extract(self, item, accessor=None):
+        '''
+        Only items with all the fields are indexed
+        
+        >>> index = CompoundIndex(packers.p_uint32, [packers.p_string, packers.p_uint32], ['status', 'created'])
+        >>> index.extract({'status': 'open', 'created': 12}, 'status,created')
+        ('open', 12)
+        >>> index.extract({'status': 'open'}, 'status,created') is None
+        True
+        '''
+        values = tuple( utils.dotted_accessor(item, a) for a in self.accessors )
+        return None if None in values else values
+    
+    def pack_value(self, value):
+        '''
+        Packs all or a leading part of a value
+        
+        >>> index = CompoundIndex(packers.p_uint32, [packers.p_string, packers.p_uint32], ['status', 'created'])
+        >>> index.pack_value(('open', 12))
+        'open\\x00\\x00\\x00\\x00\\x0c'
+        >>> index.pack_value('open')
+        'open\\x00'
+        '''
+        if not isinstance(value, (tuple, list)):
+            value = (value, )
+            
+        if len(value) > len(self.value_packers):
+            raise RepriseDataError("Index has {0} fields".format(len(self.value_packers)))
+        
+        return ''.join( p.pack(v, index=True) for p, v in zip(self.value_packers, value) )
+    
+    def to_db_key(self, value, pk):
+        '''
+        >>> CompoundIndex(packers.p_uint32, [packers.p_string, packers.p_uint32], ['status', 'created']).to_db_key(('open', 12), 34)
+        'open\\x00\\x00\\x00\\x00\\x0c\\x00\\x00\\x00\x22'
+        '''
+        return self.key_packer.append_last(self.pack_value(value), pk)
+    
+    def from_db_key(self, db_key):
+        '''
+        >>> CompoundIndex(packers.p_uint32, [packers.p_string, packers.p_uint32], ['status', 'created']).from_db_key('open\\x00\\x00\\x00\\x00\\x0c\\x00\\x00\\x00\\x22')
+        (('open', 12), 34)
+        '''
+        rest, pk = self.key_packer.extract_last(db_key)
+        
+        values = []
+        for p in self.value_packers:
+            # fixed width numbers or NUL terminated strings
+            size = p.size if hasattr(p, 'size') else rest.index(NUL) + 1
+            values.append(p.unpack(rest[:size], index=True))
+            rest = rest[size:]
+            
+        return tuple(values), pk
+    
+    def key_range(self, start_key, end_key=None):
+        '''
+        Everything matching start_key if no end_key is given, otherwise from
+        start_key up to but not including end_key
+        
+        >>> index = CompoundIndex(packers.p_uint32, [packers.p_string, packers.p_uint32], ['status', 'created'])
+        >>> index.key_range('open')
+        ('open\\x00', 'open\\x01')
+        >>> index.key_range(('open', 10), ('open', 20))
+        ('open\\x00\\x00\\x00\\x00\\n', 'open\\x00\\x00\\x00\\x00\\x14')
+        '''
+        a = self.pack_value(start_key)
+        
+        if end_key is not None:
+            return a, self.pack_value(end_key)
+        
+        return a, prefix_end(a)
+    
+    def fields(self, accessor=None):
+        return list(self.accessors)
+    
+    def pack_prefix(self, values):
+        return self.pack_value(tuple(values))
+    
+def prefix_end(prefix):
+    '''
+    Smallest key greater than every key starting with prefix, or None if there isn't one
+    
+    >>> prefix_end('ab')
+    'ac'
+    >>> prefix_end('a\\xff')
+    'b'
+    '''
+    prefix = prefix.rstrip('\xFF')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
 
 class BoundIndex(object):
     
@@ -171,15 +359,38 @@ class BoundIndex(object):
         return self.ds.store(( self.index.prepare(*x) for x in l ), commit)
         
     def iter_lookup_keys(self, start_key, end_key=None):
+        return self.iter_range_keys(*self.index.key_range(start_key, end_key))
+    
+    def iter_range_keys(self, start, end=None):
+        ' pks of the entries between the packed keys start and end (exclusive) '
+        return ( self.index.from_db_key(k)[1] for k in self.iter_range_db_keys(start, end) )
+    
+    def iter_range_db_keys(self, start, end=None):
+        ' packed keys of the entries between start and end, left packed for counting or merging '
+        return ( k for k, _r, v in self.ds.iter_items(start, end, self.end_commit, self.start_commit) if v[0] == '+' )
+    
+    def iter_lookup_items(self, start_key, end_key=None):
+        ' (pk, projection) from a CoveringIndex '
+        if not hasattr(self.index, 'from_db_value'):
+            raise RepriseDataError("Index does not store projections")
+        
         start_key, end_key = self.index.key_range(start_key, end_key)
-        return ( self.index.from_db_key(k)[1] for k, _r, v in self.ds.iter_items(start_key,
-                                                                                 end_key,
-                                                                                 self.end_commit,
-                                                                                 self.start_commit) if v == '+' )
+        return ( (self.index.from_db_key(k)[1], self.index.from_db_value(v)) for k, _r, v in self.ds.iter_items(start_key,
+                                                                                                                end_key,
+                                                                                                                self.end_commit,
+                                                                                                                self.start_commit) if v[0] == '+' )
     
     def lookup(self, start_key, end_key=None):
         return list(self.iter_lookup_keys(start_key, end_key))
     
+    def count(self, start_key, end_key=None):
+        ' number of matches, without unpacking the keys '
+        start_key, end_key = self.index.key_range(start_key, end_key)
+        return sum( 1 for _k, _r, v in self.ds.iter_items(start_key,
+                                                          end_key,
+                                                          self.end_commit,
+                                                          self.start_commit) if v[0] == '+' )
+    
 if __name__ == '__main__':
     import doctest
     print doctest.testmod()
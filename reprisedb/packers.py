@@ -122,7 +122,9 @@ class StringPacker(object):
         return value
     
     def unpack(self, value, index=False):
-        return value[:-1] if index else value
+        if index: return value[:-1]
+        # copy out LMDB buffers
+        return str(value) if isinstance(value, buffer) else value
     
     def extract_last(self, s):
         start = p_uint8.unpack(s[-1]) + 1
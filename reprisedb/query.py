@@ -0,0 +1,370 @@
+'''
+Queries over a collection, planned against its indexes.
+
+A query is a dict of accessor to either a value to match or a dict of operators
+
+    {'age': {'$gte': 30, '$lt': 40}, 'address.city': 'Leeds', 'status': {'$in': ['open', 'new']}}
+
+with operators `$eq`, `$ne`, `$gt`, `$gte`, `$lt`, `$lte` and `$in`.
+
+The planner works out the key ranges each ready index could read for the query
+and estimates how many entries each holds by counting them, up to `probe`.  The
+smallest drives the query.  Other indexes that are nearly as selective are read
+too and their pks intersected with sorted merges.  Without a usable index the
+collection is scanned.  Every predicate is checked against the documents as they
+are fetched so indexes only have to narrow down the candidates.
+'''
+
+import itertools
+import operator
+
+from reprisedb import RepriseDataError, utils, is_deleted
+from reprisedb.entries import prefix_end
+
+import logging
+logger = logging.getLogger(__name__)
+
+OPERATORS = {'$eq': ('=', operator.eq),
+             '$ne': ('!=', operator.ne),
+             '$gt': ('>', operator.gt),
+             '$gte': ('>=', operator.ge),
+             '$lt': ('<', operator.lt),
+             '$lte': ('<=', operator.le),
+             '$in': ('in', lambda a, b: a in b)}
+
+class Predicate(object):
+
+    def __init__(self, accessor, op, value):
+        if not op in OPERATORS:
+            raise RepriseDataError("Unknown operator: %s" % op)
+
+        self.accessor = accessor
+        self.op = op
+        self.value = value
+
+    def matches(self, item):
+        value = utils.dotted_accessor(item, self.accessor)
+        if value is None:
+            # missing fields only match $ne
+            return self.op == '$ne'
+        return OPERATORS[self.op][1](value, self.value)
+
+    def __repr__(self):
+        return "{0} {1} {2!r}".format(self.accessor, OPERATORS[self.op][0], self.value)
+
+def parse(query):
+    '''
+    List of Predicates for a query
+
+    >>> sorted(parse({'age': {'$gte': 30, '$lt': 40}, 'name': 'Bob'}), key=repr)
+    [age < 40, age >= 30, name = 'Bob']
+    '''
+    result = []
+    for accessor, condition in query.iteritems():
+        if not isinstance(condition, dict):
+            condition = {'$eq': condition}
+
+        for op, value in condition.iteritems():
+            result.append(Predicate(accessor, op, value))
+    return result
+
+class Bounds(object):
+    '''
+    What the predicates on one accessor allow - a set of `values` if there are
+    any $eq or $in, and a range with either end open.
+    '''
+
+    def __init__(self, predicates):
+        self.values = None
+        self.lower = self.upper = None
+        self.lower_inclusive = self.upper_inclusive = True
+        self.equality = []
+        self.range = []
+
+        for p in predicates:
+            if p.op in ('$eq', '$in'):
+                values = [p.value] if p.op == '$eq' else list(p.value)
+                self.values = values if self.values is None else [ v for v in self.values if v in values ]
+                self.equality.append(p)
+            elif p.op in ('$gt', '$gte'):
+                if self.lower is None or p.value > self.lower or (p.value == self.lower and p.op == '$gt'):
+                    self.lower, self.lower_inclusive = p.value, p.op == '$gte'
+                self.range.append(p)
+            elif p.op in ('$lt', '$lte'):
+                if self.upper is None or p.value < self.upper or (p.value == self.upper and p.op == '$lt'):
+                    self.upper, self.upper_inclusive = p.value, p.op == '$lte'
+                self.range.append(p)
+
+    def key_range(self, indexer, prefix):
+        ' (start, end) packed keys of indexer for the range following the leading values prefix '
+        base = indexer.pack_prefix(prefix)
+
+        if self.lower is None:
+            a = base
+        else:
+            a = indexer.pack_prefix(prefix + [self.lower])
+            if not self.lower_inclusive: a = prefix_end(a)
+
+        if self.upper is None:
+            b = prefix_end(base) if base else None
+        else:
+            b = indexer.pack_prefix(prefix + [self.upper])
+            if self.upper_inclusive: b = prefix_end(b)
+
+        return a, b
+
+class IndexScan(object):
+    '''
+    The entries of one index that can match the query - `ranges` of packed keys.
+    `ordered` if they come out in pk order.
+
+    The estimate counts entries up to `probe`.  Those it read are kept so a scan
+    that is used afterwards isn't read twice.
+    '''
+
+    def __init__(self, accessor, index, ranges, predicates, ordered, probe):
+        self.accessor = accessor
+        self.index = index
+        self.ranges = ranges
+        self.predicates = predicates
+        self.ordered = ordered
+        self.probe = probe
+        self.estimate = None
+        self.capped = False
+        self._db_keys = None
+
+    def estimate_size(self):
+        keys = []
+        for a, b in self.ranges:
+            keys.extend(itertools.islice(self.index.iter_range_db_keys(a, b), self.probe + 1 - len(keys)))
+            if len(keys) > self.probe: break
+
+        self.capped = len(keys) > self.probe
+        self.estimate = min(len(keys), self.probe)
+        self._db_keys = None if self.capped else keys
+        return self.estimate
+
+    def iter_db_keys(self):
+        if self._db_keys is not None:
+            return iter(self._db_keys)
+        return itertools.chain.from_iterable( self.index.iter_range_db_keys(a, b) for a, b in self.ranges )
+
+    def iter_keys(self):
+        return ( self.index.index.from_db_key(k)[1] for k in self.iter_db_keys() )
+
+    def iter_sorted(self, entry):
+        ' (packed pk, pk) in pk order '
+        i = ( (entry.to_db_key(pk), pk) for pk in self.iter_keys() )
+        return i if self.ordered else iter(sorted(i))
+
+    def explain(self):
+        if self.estimate is None:
+            self.estimate_size()
+
+        return {'index': self.accessor,
+                'predicates': sorted( repr(p) for p in self.predicates ),
+                'ranges': len(self.ranges),
+                'estimate': "{0}+".format(self.estimate) if self.capped else self.estimate}
+
+class Plan(object):
+    '''
+    How a query will be run - the `scans` to read, and the `residual` predicates
+    that nothing but fetching the documents will check.
+    '''
+
+    def __init__(self, t, collection, predicates, scans):
+        self.t = t
+        self.collection = collection
+        self.predicates = predicates
+        self.scans = scans
+
+        used = set( id(p) for s in scans for p in s.predicates )
+        self.residual = [ p for p in predicates if not id(p) in used ]
+
+    @property
+    def strategy(self):
+        if not self.scans:
+            return 'scan'
+        return 'index' if len(self.scans) == 1 else 'intersect'
+
+    def matches(self, item):
+        return all( p.matches(item) for p in self.predicates )
+
+    def execute(self, limit=None):
+        ' generator of (pk, item) '
+        entry = self.t.get_entry(self.collection)
+        logger.debug("Query on %s: %s using %s", self.collection, self.strategy, [ s.accessor for s in self.scans ])
+
+        if not self.scans:
+            i = ( x for x in entry.iter_items() if self.matches(x[1]) )
+
+        elif len(self.scans) == 1:
+            # index order, fetching as we go
+            i = ( (pk, self._get(entry, pk)) for pk in self.scans[0].iter_keys() )
+            i = ( x for x in i if x[1] is not None and self.matches(x[1]) )
+
+        else:
+            # pk order so the fetch is one sorted pass
+            keys = intersect([ s.iter_sorted(entry.entry) for s in self.scans ])
+            i = self._fetch(entry, keys)
+
+        if limit is not None:
+            i = itertools.islice(i, limit)
+        return i
+
+    def _get(self, entry, pk):
+        try:
+            return entry.get(pk)
+        except KeyError:
+            return None
+
+    def _fetch(self, entry, keys, batch_size=100):
+        while True:
+            batch = list(itertools.islice(keys, batch_size))
+            if not batch: return
+
+            values = entry.ds.iter_get(( k for k, _pk in batch ), entry.end_commit)
+            for (_k, pk), (_k, _r, v) in itertools.izip(batch, values):
+                if v is None or is_deleted(v): continue
+
+                item = entry.entry.from_db_value(v)
+                if self.matches(item):
+                    yield pk, item
+
+    def explain(self):
+        return {'collection': self.collection,
+                'strategy': self.strategy,
+                'indexes': [ s.explain() for s in self.scans ],
+                'filter': sorted( repr(p) for p in self.residual )}
+
+def intersect(streams):
+    '''
+    Items present in every one of the sorted iterators
+
+    >>> list(intersect([iter([1, 3, 5, 7]), iter([2, 3, 7, 8]), iter([3, 4, 7])]))
+    [3, 7]
+    '''
+    streams = [ iter(s) for s in streams ]
+
+    try:
+        current = [ next(s) for s in streams ]
+        while True:
+            highest = max(current)
+            if all( x == highest for x in current ):
+                yield highest
+                current = [ next(s) for s in streams ]
+                continue
+
+            for n, s in enumerate(streams):
+                while current[n] < highest:
+                    current[n] = next(s)
+    except StopIteration:
+        return
+
+class Planner(object):
+    '''
+    Plans queries for a transaction.  `probe` is the most entries counted for an
+    estimate, and an index is only intersected with the driving one if its estimate
+    is at most `intersect_ratio` times bigger - and the driving one is at least
+    `min_intersect` entries.  $in values are only expanded into key ranges up to
+    `max_ranges` of them.
+    '''
+
+    probe = 5000
+    intersect_ratio = 4
+    min_intersect = 64
+    max_indexes = 3
+    max_ranges = 64
+
+    def __init__(self, t):
+        self.t = t
+
+    def plan(self, collection, query):
+        predicates = parse(query)
+
+        by_accessor = {}
+        for p in predicates:
+            by_accessor.setdefault(p.accessor, []).append(p)
+        bounds = dict( (a, Bounds(ps)) for a, ps in by_accessor.iteritems() )
+
+        candidates = []
+        for accessor in self.t.get_collection(collection).meta['indexes']:
+            scan = self.index_scan(collection, accessor, bounds)
+            if scan is not None:
+                candidates.append(scan)
+
+        # an index using only predicates another uses can't find fewer entries
+        candidates.sort(key=lambda s: (-len(s.predicates), not s.ordered))
+        scans = []
+        for s in candidates:
+            used = set( id(p) for p in s.predicates )
+            if not any( used <= set( id(p) for p in k.predicates ) for k in scans ):
+                scans.append(s)
+
+        if len(scans) < 2:
+            chosen = scans
+        else:
+            for s in scans:
+                s.estimate_size()
+
+            # ties are usually indexes that both hit probe - prefer the one using more of the query
+            scans.sort(key=lambda s: (s.estimate, -len(s.predicates)))
+
+            chosen = scans[:1]
+            if scans[0].estimate >= self.min_intersect:
+                limit = scans[0].estimate * self.intersect_ratio
+                covered = set( id(p) for p in scans[0].predicates )
+
+                for s in scans[1:]:
+                    if len(chosen) == self.max_indexes or s.estimate > limit or s.capped: break
+
+                    # only worth reading if it narrows down predicates we haven't
+                    if all( id(p) in covered for p in s.predicates ): continue
+                    covered.update( id(p) for p in s.predicates )
+                    chosen.append(s)
+
+        return Plan(self.t, collection, predicates, chosen)
+
+    def index_scan(self, collection, accessor, bounds):
+        ' IndexScan of the index on accessor for the query, or None if it is no help '
+        c = self.t.get_collection(collection)
+        if c.is_building(accessor):
+            return None
+
+        _db, indexer = c.get_indexer(accessor)
+        fields = indexer.fields(accessor)
+
+        # leading fields with a set of values - one prefix for each combination -
+        # then optionally one with a range
+        prefixes = [[]]
+        used = []
+        last = None
+        for field in fields:
+            b = bounds.get(field)
+            if b is None: break
+
+            if b.values is not None:
+                values = sorted(set(b.values))
+                if len(prefixes) * len(values) > self.max_ranges: break
+
+                prefixes = [ p + [v] for p in prefixes for v in values ]
+                used.extend(b.equality)
+                continue
+
+            if b.range:
+                last = b
+                used.extend(b.range)
+            break
+
+        if not used:
+            return None
+
+        if last is None:
+            ranges = [ (k, prefix_end(k)) for k in ( indexer.pack_prefix(p) for p in prefixes ) ]
+        else:
+            ranges = [ last.key_range(indexer, p) for p in prefixes ]
+
+        # a single value for every field leaves only the pks to order by
+        ordered = last is None and len(prefixes) == 1 and len(prefixes[0]) == len(fields)
+
+        return IndexScan(accessor, self.t.get_index(collection, accessor), ranges, used, ordered, self.probe)
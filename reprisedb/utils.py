@@ -1,4 +1,8 @@
-
+import collections
+import hashlib
+import math
+import struct
+import threading
 
 def dotted_accessor(d, accessor, default=None):
     if d is None:
@@ -10,4 +14,122 @@ def dotted_accessor(d, accessor, default=None):
         return d
     except KeyError:
         return default
-    
\ No newline at end of file
+        
+class BloomFilter(object):
+    '''
+    Fixed size bloom filter using double hashing of an md5 digest.  A key that has
+    been added is always reported as present, others are reported as present with
+    a probability of roughly error_rate until more than capacity keys are added.
+    '''
+    
+    header = struct.Struct('>QIQQ')
+    
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.count = 0
+        self.size = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size / float(capacity) * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        
+    def _positions(self, key):
+        a, b = struct.unpack('>QQ', hashlib.md5(key).digest())
+        for i in xrange(self.hashes):
+            yield (a + i * b) % self.size
+        
+    def add(self, key):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+        
+    def full(self):
+        return self.count >= self.capacity
+            
+    def __contains__(self, key):
+        for p in self._positions(key):
+            if not self.bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+    
+    def save(self, path):
+        with open(path, 'wb') as fp:
+            fp.write(self.header.pack(self.size, self.hashes, self.capacity, self.count))
+            fp.write(self.bits)
+            
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        
+        bloom = cls.__new__(cls)
+        bloom.size, bloom.hashes, bloom.capacity, bloom.count = cls.header.unpack_from(data)
+        bloom.bits = bytearray(data[cls.header.size:])
+        return bloom
+        
+class ValueCache(object):
+    '''
+    Bounded LRU cache of packed values.  Each entry holds the value read for a key
+    along with the range of revisions it is known to be current for - from the
+    revision it was written at to the highest revision it has been read at.
+    
+    Values are kept packed so nothing a reader does to what it unpacks can change
+    the cache.  Safe to share between threads.
+    '''
+    
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        
+    def __len__(self):
+        return len(self._entries)
+        
+    def get(self, key, revision, start_revision=0):
+        '''
+        Returns (packed revision, value) if the cached value is the one a read of key
+        at revision would find, otherwise None
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            
+            if entry is None or not start_revision <= entry[0] <= revision <= entry[1]:
+                self.misses += 1
+                return None
+            
+            # most recently used
+            del self._entries[key]
+            self._entries[key] = entry
+            
+            self.hits += 1
+            return entry[2], entry[3]
+    
+    def peek(self, key):
+        ' (first revision, last revision, packed revision, value) or None '
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else tuple(entry)
+    
+    def put(self, key, first, last, packed_revision, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = [first, last, packed_revision, value]
+            
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            
+    def invalidate(self, key, revision):
+        ' a new value has been written for key at revision '
+        with self._lock:
+            entry = self._entries.get(key)
+            
+            if entry is not None and entry[1] >= revision:
+                if entry[0] < revision:
+                    entry[1] = revision - 1
+                else:
+                    del self._entries[key]
+                
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
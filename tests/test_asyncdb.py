@@ -0,0 +1,85 @@
+from unittest import TestCase
+import os.path
+
+from reprisedb import database, drivers, asyncdb
+
+class AsyncDatabaseTestCase(TestCase):
+
+    TESTDIR = 'test_output_async'
+
+    def setUp(self):
+        os.makedirs(self.TESTDIR)
+        self.db = database.RepriseDB(path=self.TESTDIR, driver=drivers.LMDBDriver)
+        self.adb = asyncdb.AsyncRepriseDB(self.db, workers=4, chunk_size=3)
+
+        t = self.db.begin()
+        t.create_collection('people')
+        t.add_index('people', 'name')
+        t.bulk_put('people', ( (x, {'name': 'Person %02d' % x}) for x in range(10) ))
+        t.commit()
+
+    def tearDown(self):
+        self.adb.close()
+        for f in os.listdir(self.TESTDIR):
+            os.unlink(os.path.join(self.TESTDIR, f))
+        os.rmdir(self.TESTDIR)
+
+    def read_all(self, scan):
+        chunks = []
+        while True:
+            chunk = scan.next_chunk().result(5)
+            if not chunk: return chunks
+            chunks.append(chunk)
+
+    def test_get(self):
+        t = self.adb.begin().result(5)
+        self.assertEqual(t.get('people', 3).result(5), {'name': 'Person 03'})
+        self.assertEqual(t.get('people', 30).result(5), None)
+        self.assertEqual(t.lookup('people', 'name', 'Person 05').result(5), [5])
+
+        results = []
+        t.count('people').add_done_callback(lambda f: results.append(f.result()))
+        self.adb.close()
+        self.assertEqual(results, [10])
+
+    def test_errors(self):
+        t = self.adb.begin().result(5)
+        f = t.lookup('missing', 'name', 'Bob')
+        self.assertRaises(KeyError, f.result, 5)
+        self.assertTrue(isinstance(f.exception(), KeyError))
+
+    def test_scans(self):
+        t = self.adb.begin().result(5)
+
+        chunks = self.read_all(t.keys('people'))
+        self.assertEqual([ len(c) for c in chunks ], [3, 3, 3, 1])
+        self.assertEqual(sum(chunks, []), range(10))
+
+        self.assertEqual(sum(self.read_all(t.keys('people', 2, 6)), []), [2, 3, 4, 5])
+
+        chunks = self.read_all(t.each('people', 2, 6, chunk_size=10))
+        self.assertEqual(chunks, [[ (x, {'name': 'Person %02d' % x}) for x in range(2, 6) ]])
+
+        # later commits are not seen part way through
+        scan = t.keys('people')
+        self.assertEqual(scan.next_chunk().result(5), [0, 1, 2])
+
+        other = self.db.begin()
+        other.put('people', 5, None)
+        other.put('people', 20, {'name': 'Late'})
+        other.commit()
+
+        self.assertEqual(sum(self.read_all(scan), []), range(3, 10))
+
+    def test_commit(self):
+        ts = [ self.adb.begin().result(5) for _i in range(8) ]
+
+        puts = [ t.put('people', 100 + i, {'name': 'New'}) for i, t in enumerate(ts) ]
+        for f in puts: f.result(5)
+
+        commits = [ t.commit() for t in ts ]
+        self.assertEqual(sorted( f.result(5) for f in commits ), range(3, 11))
+
+        t = self.adb.begin().result(5)
+        self.assertEqual(t.count('people').result(5), 18)
+        self.assertEqual(t.lookup('people', 'name', 'New').result(5), range(100, 108))
@@ -1,9 +1,26 @@
 from unittest import TestCase
+import gc
 import os.path
+import multiprocessing
+import threading
 
 import logging
 
-from reprisedb import database, drivers
+from reprisedb import database, drivers, RepriseDataError
+
+def _commit_worker(path, n, count):
+    # each process opens its own handle
+    db = database.RepriseDB(path=path, driver=drivers.LMDBDriver)
+    for x in range(count):
+        t = db.begin()
+        t.put('people', n * 100 + x, 'Person %d' % x)
+        t.commit()
+        
+def _index_worker(path):
+    db = database.RepriseDB(path=path, driver=drivers.LMDBDriver)
+    t = db.begin()
+    t.add_index('people', 'name')
+    t.commit()
 
 class DatabaseTestCase(TestCase):
     
@@ -81,7 +98,255 @@ class DatabaseTestCase(TestCase):
         self.assertEqual(t.lookup('people', 'name', 'Andy', 'C', offset=2), [6, 14])
         self.assertEqual(t.lookup('people', 'name', 'Andy', 'C', length=2), [9, 3])
         self.assertEqual(t.lookup('people', 'name', 'Andy', 'C', offset=1, length=2), [3, 6])
+
+    def test_covering_index(self):
+        t = self.db.begin()
+        t.create_collection('people')
+        t.add_index('people', 'name', 'string', covering=['age', 'address.city'])
+        t.bulk_put('people', ((3 , {'name': 'Bob', 'age': 32, 'address': {'city': 'Leeds'}}),
+                              (6 , {'name': 'Brenda', 'age': 27}),
+                              (9 , {'name': 'Andy', 'age': 45})))
+        t.commit()
+
+        t = self.db.begin()
+        self.assertEqual(t.lookup_items('people', 'name', 'B', 'C'),
+                         [(3, {'age': 32, 'address.city': 'Leeds'}), (6, {'age': 27, 'address.city': None})])
+        self.assertEqual(t.lookup_count('people', 'name', 'B', 'C'), 2)
+        self.assertEqual(t.lookup_count('people', 'name', 'Bob'), 1)
+
+        # projected field changes without the indexed value changing
+        t.put('people', 3, {'name': 'Bob', 'age': 33})
+        t.put('people', 6, {'name': 'Zoe', 'age': 27})
+        t.commit()
+
+        # answered without the collection
+        t = self.db.begin()
+        opened = []
+        get_datastore = t.get_datastore
+        t.get_datastore = lambda name: opened.append(name) or get_datastore(name)
+        self.assertEqual(t.lookup_items('people', 'name', 'B', 'C'), [(3, {'age': 33, 'address.city': None})])
+        self.assertEqual(t.lookup_items('people', 'name', '', '~', offset=1), [(3, {'age': 33, 'address.city': None}),
+                                                                              (6, {'age': 27, 'address.city': None})])
+        self.assertEqual(t.lookup_count('people', 'name', '', '~'), 3)
+        self.assertEqual(set(opened), set(['people.name']))
+
+        # history is kept
+        t = self.db.begin(2)
+        self.assertEqual(t.lookup_items('people', 'name', 'Bob'), [(3, {'age': 32, 'address.city': 'Leeds'})])
+
+        t = self.db.begin()
+        t.add_index('people', 'age', 'uint32')
+        self.assertRaises(RepriseDataError, t.lookup_items, 'people', 'age', 30, 40)
+        self.assertEqual(t.lookup_count('people', 'age', 30, 40), 1)
+        self.assertEqual(t.count('people'), 3)
+        self.assertEqual(t.count('people', 4, 9), 1)
+
+    def test_compound_index(self):
+        t = self.db.begin()
+        t.create_collection('tickets')
+        t.bulk_put('tickets', {1: {'status': 'open', 'created': 30},
+                               2: {'status': 'closed', 'created': 10},
+                               3: {'status': 'open', 'created': 20},
+                               4: {'status': 'open'}})
+        t.commit()
+        
+        t.add_index('tickets', [('status', 'string'), ('created', 'uint32')])
+        t.commit()
+        
+        t = self.db.begin()
+        self.assertEqual(t.get_collection('tickets').meta['indexes']['status,created'],
+                         ['CompoundIndex', ['string', 'uint32'], ['status', 'created']])
+        
+        # prefix, ordered by the trailing field
+        self.assertEqual(t.lookup('tickets', 'status,created', 'open'), [3, 1])
+        self.assertEqual(t.lookup('tickets', ('status', 'created'), ('open', 30)), [1])
+        self.assertEqual(t.lookup('tickets', 'status,created', ('open', 0), ('open', 30)), [3])
+        self.assertEqual(t.lookup('tickets', 'status,created', 'closed', 'open'), [2])
+        self.assertEqual(t.lookup_count('tickets', 'status,created', 'open'), 2)
+        
+        t.put('tickets', 3, {'status': 'closed', 'created': 20})
+        t.put('tickets', 4, {'status': 'open', 'created': 5})
+        t.put('tickets', 5, {'status': 'open', 'created': 40})
+        
+        self.assertEqual(t.lookup('tickets', 'status,created', 'open'), [4, 1, 5])
+        self.assertEqual(t.lookup('tickets', 'status,created', ('open', 10), ('open', 50)), [1, 5])
+        self.assertEqual(t.lookup('tickets', 'status,created', 'closed'), [2, 3])
+        
+    def test_single_field_list_index(self):
+        t = self.db.begin()
+        t.create_collection('people')
+        t.bulk_put('people', {1: {'age': 30}, 2: {'age': 4}, 3: {'age': 100}})
+        t.commit()
+        
+        t.add_index('people', [('age', 'uint32')])
+        t.commit()
+        
+        t = self.db.begin()
+        self.assertEqual(t.get_collection('people').meta['indexes']['age'], ['SimpleIndex', 'uint32'])
+        self.assertEqual(t.lookup('people', 'age', 4, 50), [2, 1])
+        
+    def test_drop_index(self):
+        t = self.db.begin()
+        t.create_collection('people')
+        t.add_index('people', 'name')
+        t.bulk_put('people', {1: {'name': 'Bob'}, 2: {'name': 'Fred'}})
+        t.commit()
+        
+        t.drop_index('people', 'name')
+        t.commit()
+        self.assertFalse('people.name' in self.db.driver.dbs)
+        
+        t = self.db.begin()
+        self.assertEqual(t.get_collection('people').meta['indexes'], {})
+        self.assertRaises(KeyError, t.lookup, 'people', 'name', 'Bob')
+        t.put('people', 1, {'name': 'Robert'})
+        t.commit()
+        
+        # a new index starts from nothing
+        t.add_index('people', 'name')
+        t.commit()
+        
+        t = self.db.begin()
+        self.assertEqual(t.lookup('people', 'name', 'Bob'), [])
+        self.assertEqual(t.lookup('people', 'name', 'A', 'Z'), [2, 1])
         
+    def test_vacuum_index(self):
+        t = self.db.begin()
+        t.create_collection('people')
+        t.add_index('people', 'status')
+        t.bulk_put('people', ( (x, {'status': 'new'}) for x in range(10) ))
+        t.commit()
+        
+        for status in ('open', 'closed', 'open'):
+            t = self.db.begin()
+            t.bulk_put('people', ( (x, {'status': status}) for x in range(5) ))
+            t.commit()
+        
+        rds = self.db.get_rds('people.status')
+        self.assertEqual(len(list(rds.iter_revisions())), 40)
+        
+        self.assertEqual(self.db.vacuum_index('people', before_commit=4), 20)
+        self.assertEqual(len(list(rds.iter_revisions())), 20)
+        self.assertEqual(self.db.begin(4).lookup('people', 'status', 'closed'), range(5))
+        
+        self.assertEqual(self.db.vacuum_index('people', self.db.current_commit()), 10)
+        self.assertEqual(len(list(rds.iter_revisions())), 10)
+        
+        t = self.db.begin()
+        self.assertEqual(t.lookup('people', 'status', 'open'), range(5))
+        self.assertEqual(t.lookup('people', 'status', 'new'), range(5, 10))
+        self.assertEqual(t.lookup('people', 'status', 'closed'), [])
+        
+    def test_index_history(self):
+        self.load_data('people', {1: {'name': 'Bob'}, 2: {'name': 'Andy'}})
+        t = self.db.begin()
+        t.put('people', 1, {'name': 'Robert'})
+        t.delete('people', 2)
+        t.commit()
+        
+        t = self.db.begin()
+        t.add_index('people', 'name')
+        t.commit()
+        
+        t = self.db.begin()
+        self.assertEqual(t.lookup('people', 'name', '', '~'), [1])
+        self.assertEqual(t.lookup('people', 'name', 'Robert'), [1])
+        
+        index = t.get_index('people', 'name')
+        index.end_commit = 2
+        self.assertEqual(index.lookup('', '~'), [2, 1])
+        self.assertEqual(index.lookup('Bob'), [1])
+
+    def test_find(self):
+        cities = ['Leeds', 'York', 'Hull', 'Bath']
+        self.load_data('people', ( (x, {'name': 'Person %d' % x, 'age': x % 80, 'city': cities[x % 4]}) for x in range(400) ))
+
+        t = self.db.begin()
+        t.add_index('people', 'age', 'uint32')
+        t.add_index('people', [('city', 'string'), ('age', 'uint32')])
+        t.commit()
+
+        def expected(f):
+            return [ (pk, item) for pk, item in t.each('people') if f(item) ]
+
+        t = self.db.begin()
+        query = {'age': {'$gte': 30}, 'city': 'Leeds'}
+        self.assertEqual(t.explain('people', query),
+                         {'collection': 'people',
+                          'strategy': 'index',
+                          'indexes': [{'index': 'city,age',
+                                       'predicates': ['age >= 30', "city = 'Leeds'"],
+                                       'ranges': 1,
+                                       'estimate': 60}],
+                          'filter': []})
+        self.assertEqual(sorted(t.find('people', query)), expected(lambda x: x['age'] >= 30 and x['city'] == 'Leeds'))
+
+        # ordered by the index, up to limit
+        self.assertEqual([ pk for pk, _item in t.find('people', query, limit=3) ], [32, 112, 192])
+
+        query = {'age': {'$gt': 10, '$lte': 12}, 'name': {'$ne': 'Person 11'}}
+        plan = t.explain('people', query)
+        self.assertEqual([ i['index'] for i in plan['indexes'] ], ['age'])
+        self.assertEqual(plan['filter'], ["name != 'Person 11'"])
+        self.assertEqual(sorted(t.find('people', query)), expected(lambda x: 10 < x['age'] <= 12 and x['name'] != 'Person 11'))
+
+        query = {'city': {'$in': ['York', 'Bath']}, 'age': {'$lt': 4}}
+        self.assertEqual(t.explain('people', query)['indexes'][0]['ranges'], 2)
+        self.assertEqual(sorted(t.find('people', query)), expected(lambda x: x['city'] in ('York', 'Bath') and x['age'] < 4))
+
+        # nothing indexed
+        query = {'name': 'Person 7'}
+        self.assertEqual(t.explain('people', query)['strategy'], 'scan')
+        self.assertEqual(t.find('people', query), [(7, {'name': 'Person 7', 'age': 7, 'city': 'Bath'})])
+
+        # sees changes in the transaction
+        t.put('people', 7, {'name': 'Person 7', 'age': 50, 'city': 'Leeds'})
+        t.delete('people', 32)
+        self.assertEqual([ pk for pk, _item in t.find('people', {'age': 50, 'city': 'Leeds'}) ], [7])
+        self.assertEqual(t.find('people', {'age': 32}), [(112, {'name': 'Person 112', 'age': 32, 'city': 'Leeds'}),
+                                                       (192, {'name': 'Person 192', 'age': 32, 'city': 'Leeds'}),
+                                                       (272, {'name': 'Person 272', 'age': 32, 'city': 'Leeds'}),
+                                                       (352, {'name': 'Person 352', 'age': 32, 'city': 'Leeds'})])
+
+    def test_find_intersect(self):
+        statuses = ['new', 'open', 'pending', 'closed']
+        colours = ['red', 'green', 'blue', 'white', 'black']
+        self.load_data('tickets', ( (x, {'status': statuses[x % 4], 'colour': colours[x % 5]}) for x in range(400) ))
+
+        t = self.db.begin()
+        t.add_index('tickets', 'status')
+        t.add_index('tickets', 'colour')
+        t.commit()
+
+        t = self.db.begin()
+        query = {'status': 'open', 'colour': 'red'}
+        plan = t.explain('tickets', query)
+        self.assertEqual(plan['strategy'], 'intersect')
+        self.assertEqual([ (i['index'], i['estimate']) for i in plan['indexes'] ], [('colour', 80), ('status', 100)])
+        self.assertEqual([ pk for pk, _item in t.find('tickets', query) ], range(5, 400, 20))
+        self.assertEqual(len(t.find('tickets', query, limit=5)), 5)
+
+        # a range doesn't come out in pk order
+        query = {'status': {'$in': ['open', 'new']}, 'colour': {'$gte': 'red'}}
+        self.assertEqual(t.explain('tickets', query)['strategy'], 'intersect')
+        self.assertEqual([ pk for pk, _item in t.find('tickets', query) ],
+                         [ x for x in range(400) if x % 4 in (0, 1) and x % 5 in (0, 3) ])
+
+        # too few to be worth intersecting
+        plan = t.explain('tickets', {'status': 'open', 'colour': {'$gt': 'white'}})
+        self.assertEqual(plan['strategy'], 'index')
+        self.assertEqual(plan['indexes'][0]['estimate'], 0)
+        self.assertEqual(plan['filter'], ["status = 'open'"])
+
+        # still being built
+        t = self.db.begin()
+        t.add_index('tickets', [('status', 'string'), ('colour', 'string')], online=True)
+        t.commit()
+
+        t = self.db.begin()
+        self.assertEqual([ i['index'] for i in t.explain('tickets', query)['indexes'] ], ['colour', 'status'])
+        self.assertEqual(len(t.find('tickets', query)), 80)
+
     def test_indexing(self):
         t = self.db.begin()
         t.create_collection('people')
@@ -107,6 +372,52 @@ class DatabaseTestCase(TestCase):
         self.assertEqual(t.lookup('people', 'age', 18, 30), [1, 3, 2])
         
         
+    def test_bulk_put_batches(self):
+        t = self.db.begin()
+        t.create_collection('people')
+        t.add_index('people', 'name', 'string')
+        t.bulk_put('people', [(5, {'name': 'Eve'}), (2, {'name': 'Bob'})])
+        t.commit()
+        
+        t.bulk_put('people', [(4, {'name': 'Dave'}),
+                              (2, {'name': 'Bob'}),
+                              (5, {'name': 'Eve'}),
+                              (5, {'name': 'Evelyn'}),
+                              (1, {'name': 'Andy'}),
+                              (2, None)], batch_size=2)
+        
+        self.assertEqual(t.keys('people'), [1, 4, 5])
+        self.assertEqual(t.lookup('people', 'name', '', '~'), [1, 4, 5])
+        self.assertEqual(t.lookup('people', 'name', 'Eve'), [])
+        self.assertEqual(t._updates['people'], set([1, 2, 4, 5]))
+        
+        t.commit()
+        self.assertEqual(t.get('people', 5), {'name': 'Evelyn'})
+        
+    def test_collection_cache(self):
+        self.load_data('people', {1: {'name': 'Bob'}})
+        commit = self.db.current_commit()
+        
+        t1 = self.db.begin()
+        people = t1.get_collection('people')
+        self.assertTrue(self.db.begin().get_collection('people') is people)
+        
+        t2 = self.db.begin()
+        t2.add_index('people', 'name')
+        self.assertFalse(t2.get_collection('people') is people)
+        self.assertEqual(people.meta['indexes'], {})
+        
+        # not invalidated until the commit
+        self.assertTrue(self.db.begin().get_collection('people') is people)
+        t2.commit()
+        
+        c = self.db.begin().get_collection('people')
+        self.assertFalse(c is people)
+        self.assertEqual(c.meta['indexes'].keys(), ['name'])
+        
+        self.assertTrue(t1.get_collection('people') is people)
+        self.assertEqual(self.db.begin(commit).get_collection('people').meta['indexes'], {})
+        
     def test_blocked_commit(self):
         t = self.db.begin()
         t.create_collection('people', value_packer='p_string')
@@ -129,6 +440,27 @@ class DatabaseTestCase(TestCase):
             
         self.assertEqual(t2.conflicts(), [('people', 3, 3)])
                 
+    def test_conflicts_many_commits(self):
+        self.load_data('people', {1: 'Bob'}, value_packer='p_string')
+        
+        t = self.db.begin()
+        t.put('people', 1, 'Robert')
+        t.put('people', 50, 'Zed')
+        
+        for x in range(2, 30):
+            t1 = self.db.begin()
+            t1.put('people', x, 'Person %d' % x)
+            if x == 20:
+                t1.put('people', 50, 'Zach')
+            t1.commit()
+        
+        self.assertEqual(t.conflicts(), [('people', 50, 21)])
+        
+        t.rollback()
+        t.put('people', 1, 'Robert')
+        self.assertEqual(t.conflicts(), None)
+        self.assertEqual(t.current_commit, self.db.current_commit())
+        
     def test_nonblocked_commit(self):
         t = self.db.begin()
         t.create_collection('people', value_packer='p_string')
@@ -149,4 +481,435 @@ class DatabaseTestCase(TestCase):
         t2.commit()
             
         t = self.db.begin()
-        self.assertEqual([ t.get('people', x) for x in [1, 2, 3]], ['Jane', 'Andy', 'Dave'])
\ No newline at end of file
+        self.assertEqual([ t.get('people', x) for x in [1, 2, 3]], ['Jane', 'Andy', 'Dave'])
+        
+class LMDBDatabaseTestCase(DatabaseTestCase):
+    
+    def setUp(self):
+        self.db = database.RepriseDB(path=self.TESTDIR, driver=drivers.LMDBDriver)
+        
+    def test_atomic_commit(self):
+        self.load_data('people', {1: 'Bob'}, value_packer='p_string')
+        
+        t = self.db.begin()
+        t.put('people', 1, 'Robert')
+        t.put('people', 2, 'Fred')
+        
+        # '_commits' is written before 'people' fails
+        def fail(data, revision, txn=None, append=False):
+            raise IOError("Disk full")
+        self.db.get_rds('people').store = fail
+        
+        with self.assertRaises(IOError):
+            t.commit()
+            
+        del self.db.get_rds('people').store
+        
+        # the commit number is not used up
+        self.assertEqual(self.db.current_commit(), 2)
+        
+        t = self.db.begin()
+        self.assertEqual(t.get('people', 1), 'Bob')
+        self.assertEqual(t.get('people', 2), None)
+        self.assertEqual(t.get('_commits', 3), None)
+        
+    def test_snapshot_transaction(self):
+        self.load_data('people', {1: 'Bob', 2: 'Fred'}, value_packer='p_string')
+        
+        t1 = self.db.begin(snapshot=True)
+        self.assertEqual(t1.get('people', 1), 'Bob')
+        
+        t2 = self.db.begin()
+        t2.put('people', 3, 'Dave')
+        t2.commit()
+        
+        self.assertEqual(t1.keys('people'), [1, 2])
+        t1.put('people', 1, 'Robert')
+        t1.commit()
+        
+        self.assertEqual(t1.keys('people'), [1, 2, 3])
+        self.assertEqual(t1.get('people', 1), 'Robert')
+        
+    def test_snapshot_conflicts(self):
+        self.load_data('people', {1: 'Bob', 2: 'Fred'}, value_packer='p_string')
+        
+        t1 = self.db.begin(snapshot=True)
+        t1.put('people', 1, 'Robert')
+        self.assertEqual(t1.keys('people'), [1, 2])
+        
+        t2 = self.db.begin()
+        t2.put('people', 3, 'Dave')
+        t2.commit()
+        
+        # moved on to t2's commit so must read what it wrote
+        self.assertEqual(t1.conflicts(), None)
+        self.assertEqual(t1.current_commit, t2.current_commit)
+        self.assertEqual(t1.keys('people'), [1, 2, 3])
+        self.assertEqual(t1.get('people', 3), 'Dave')
+        self.assertEqual(t1.get('people', 1), 'Robert')
+        
+    def test_spilled_transaction(self):
+        self.db.buffer_size = 100
+        
+        t = self.db.begin()
+        t.create_collection('people')
+        t.add_index('people', 'name', 'string')
+        t.bulk_put('people', ( (x, {'name': 'Person %02d' % x}) for x in xrange(50) ))
+        t.put('people', 3, {'name': 'Dave'})
+        
+        self.assertNotEqual(t.get_datastore('people').datastores[0].scratch, None)
+        self.assertEqual(t.get('people', 3), {'name': 'Dave'})
+        self.assertEqual(t.count('people'), 50)
+        self.assertEqual(t.lookup('people', 'name', 'Person 48', 'Z'), [48, 49])
+        
+        t.commit()
+        
+        t = self.db.begin()
+        self.assertEqual(t.keys('people'), range(50))
+        self.assertEqual(t.lookup('people', 'name', 'Dave'), [3])
+        self.assertEqual(t.lookup('people', 'name', 'Person 03'), [])
+        
+        # neither committed nor rolled back
+        t.bulk_put('people', ( (x, {'name': 'Person %02d' % x}) for x in xrange(50, 100) ))
+        path = t.get_datastore('people').datastores[0].scratch.env._path
+        del t
+        gc.collect()
+        self.assertFalse(os.path.exists(path))
+        
+    def test_prune_job(self):
+        self.load_data('people', {}, value_packer='p_string')
+        for r in range(5):
+            t = self.db.begin()
+            for x in range(10):
+                t.put('people', x, 'Person %d-%d' % (x, r))
+            t.commit()
+        
+        # everything is recent
+        job = database.PruneJob(self.db, 'people', keep=2, max_age=3600)
+        self.assertTrue(job.run())
+        self.assertEqual(len(list(self.db.get_rds('people').iter_revisions())), 50)
+        
+        job = database.PruneJob(self.db, 'people', keep=2, batch_size=3)
+        commit = self.db.current_commit()
+        self.assertFalse(job.run(ops_budget=6))
+        self.assertEqual(job.state()['pruned'], 18)
+        
+        # checkpoints aren't commits
+        self.assertEqual(self.db.current_commit(), commit)
+        self.assertEqual(database.PruneJob(self.db, 'people').state()['pruned'], 18)
+        
+        # carries on from the checkpoint
+        self.assertTrue(job.run())
+        self.assertEqual(job.state(), None)
+        
+        rds = self.db.get_rds('people')
+        self.assertEqual(len(list(rds.iter_revisions())), 20)
+        self.assertEqual([ v for _r, v in rds.iter_history('\x00\x00\x00\x04') ], ['Person 4-4', 'Person 4-3'])
+        
+    def test_index_builder(self):
+        self.load_data('people', ( (x, {'name': 'Person %d' % x}) for x in range(10) ))
+        t = self.db.begin()
+        t.put('people', 3, {'name': 'Bob'})
+        t.commit()
+        
+        t = self.db.begin()
+        t.add_index('people', 'name', online=True)
+        t.commit()
+        
+        # maintained from here on
+        t = self.db.begin()
+        t.put('people', 4, {'name': 'Bobby'})
+        t.put('people', 10, {'name': 'Bob'})
+        t.commit()
+        
+        # scans until built
+        t = self.db.begin()
+        self.assertTrue(t.get_collection('people').is_building('name'))
+        self.assertEqual(t.lookup('people', 'name', 'Bob', 'Bp'), [3, 10, 4])
+        self.assertEqual(t.lookup('people', 'name', 'Person 1'), [1])
+        self.assertEqual(t.lookup_count('people', 'name', 'Person', 'Q'), 8)
+        
+        builder = database.IndexBuilder(self.db, 'people', 'name', batch_size=3)
+        commit = self.db.current_commit()
+        self.assertFalse(builder.run(ops_budget=6))
+        self.assertEqual(builder.state()['start_key'], '\x00\x00\x00\x06')
+        self.assertEqual(self.db.current_commit(), commit)
+        
+        # a transaction from before the index was added can't commit
+        old = self.db.begin(3)
+        old.put('people', 11, {'name': 'Late'})
+        self.assertRaises(database.RepriseDBIntegrityError, old.commit)
+        
+        t = self.db.begin()
+        t.put('people', 5, {'name': 'Bobbie'})
+        t.delete('people', 0)
+        t.commit()
+        
+        self.assertTrue(builder.run())
+        self.assertEqual(builder.state(), None)
+        
+        t = self.db.begin()
+        self.assertFalse(t.get_collection('people').is_building('name'))
+        self.assertEqual(t.lookup('people', 'name', 'Bob', 'Bp'), [3, 10, 5, 4])
+        self.assertEqual(t.lookup('people', 'name', 'Person', 'Q'), [1, 2, 6, 7, 8, 9])
+        
+        # history is indexed too
+        index = t.get_index('people', 'name')
+        index.end_commit = 2
+        self.assertEqual(index.lookup('Person 3'), [3])
+        self.assertEqual(index.lookup('Bob'), [])
+        
+        self.assertTrue(database.IndexBuilder(self.db, 'people', 'name').run())
+        
+    def test_index_builder_dropped(self):
+        self.load_data('people', ( (x, {'name': 'Person %d' % x}) for x in range(10) ))
+        t = self.db.begin()
+        t.add_index('people', 'name', online=True)
+        t.commit()
+        
+        builder = database.IndexBuilder(self.db, 'people', 'name', batch_size=3)
+        self.assertFalse(builder.run(ops_budget=3))
+        
+        t.drop_index('people', 'name')
+        t.commit()
+        self.assertEqual(builder.state(), None)
+        self.assertTrue(builder.run())
+        
+        # built again from the start
+        t.add_index('people', 'name', online=True)
+        t.commit()
+        self.assertFalse(builder.run(ops_budget=3))
+        self.assertEqual(builder.state()['start_key'], '\x00\x00\x00\x03')
+        self.assertTrue(builder.run())
+        
+        t = self.db.begin()
+        self.assertFalse(t.get_collection('people').is_building('name'))
+        self.assertEqual(t.lookup('people', 'name', 'Person 0', 'Person 3'), [0, 1, 2])
+        
+    def test_commit_after(self):
+        self.load_data('people', {1: 'Bob'}, value_packer='p_string')
+        t = self.db.begin()
+        
+        timestamp = t.get('_commits', 2)['timestamp']
+        self.assertEqual(self.db.commit_after(timestamp), 2)
+        self.assertEqual(self.db.commit_after(timestamp + 1), 3)
+        self.assertEqual(self.db.commit_after(0), 1)
+        
+    def test_group_commit(self):
+        self.load_data('people', {}, value_packer='p_string')
+        
+        t1 = self.db.begin()
+        t1.put('people', 1, 'Bob')
+        t2 = self.db.begin()
+        t2.put('people', 2, 'Fred')
+        t3 = self.db.begin()
+        t3.put('people', 1, 'Robert')
+        
+        requests = [ database._CommitRequest(t, 2, True) for t in (t1, t2, t3) ]
+        self.db._write_group(requests)
+        
+        self.assertEqual([ r.error for r in requests[:2] ], [None, None])
+        self.assertTrue(isinstance(requests[2].error, database.RepriseDBIntegrityError))
+        self.assertEqual((t1.current_commit, t2.current_commit), (3, 4))
+        self.assertEqual(self.db.current_commit(), 4)
+        
+        t = self.db.begin()
+        self.assertEqual(t.get('_commits', 3)['updates'], {'people': [1]})
+        self.assertEqual(t.get('_commits', 4)['updates'], {'people': [2]})
+        self.assertEqual(t.keys('people'), [1, 2])
+        
+    def test_commit_rereads_counter(self):
+        self.load_data('people', {1: 'Bob'}, value_packer='p_string')
+        current = self.db.current_commit()
+        
+        # as if the counter had been moved back past a commit by another process
+        self.db._current_commit = current - 1
+        t = self.db.begin(current)
+        t.put('people', 2, 'Fred')
+        t.commit()
+        
+        self.assertEqual(t.current_commit, current + 1)
+        self.assertEqual(self.db.current_commit(), current + 1)
+        t = self.db.begin()
+        self.assertEqual(t.get('_commits', current)['updates']['people'], [1])
+        self.assertEqual(t.keys('people'), [1, 2])
+        
+    def test_failed_group_commit(self):
+        self.load_data('people', {}, value_packer='p_string')
+        
+        def fail(txn, commit):
+            raise RuntimeError("write failed")
+        
+        ts = [ self.db.begin() for _i in range(3) ]
+        for n, t in enumerate(ts):
+            t.put('people', n, 'Person %d' % n)
+        ts[1]._write = fail
+        
+        # the others are still written
+        requests = [ database._CommitRequest(t, 2, True) for t in ts ]
+        self.db._write_group(requests)
+        
+        self.assertEqual([ r.error for r in requests[::2] ], [None, None])
+        self.assertTrue(isinstance(requests[1].error, RuntimeError))
+        # the failed one was only moved on as far as its conflicts were checked
+        self.assertEqual([ t.current_commit for t in ts ], [3, 3, 4])
+        self.assertEqual(self.db.begin().get('_commits', 5), None)
+        self.assertEqual(self.db.current_commit(), 4)
+        self.assertEqual(self.db.begin().keys('people'), [0, 2])
+        
+    def test_group_commit_add_index(self):
+        self.load_data('people', {1: {'name': 'Bob'}})
+        
+        t1 = self.db.begin()
+        t1.add_index('people', 'name')
+        t2 = self.db.begin()
+        t2.put('people', 2, {'name': 'Fred'})
+        
+        # t2's put wouldn't be indexed by the index t1 adds earlier in the group
+        requests = [ database._CommitRequest(t, 2, True) for t in (t1, t2) ]
+        self.db._write_group(requests)
+        
+        self.assertEqual(requests[0].error, None)
+        self.assertTrue(isinstance(requests[1].error, database.RepriseDBIntegrityError))
+        self.assertEqual(self.db.begin().lookup('people', 'name', 'A', 'Z'), [1])
+        
+    def test_failed_commit_retry(self):
+        self.load_data('people', {1: 'Bob'}, value_packer='p_string')
+        
+        t1 = self.db.begin()
+        t1.put('people', 1, 'Robert')
+        write = t1._write
+        def fail(txn, commit):
+            raise RuntimeError("write failed")
+        t1._write = fail
+        
+        self.assertRaises(RuntimeError, t1.commit)
+        self.assertEqual(t1.current_commit, 2)
+        self.assertEqual(self.db.begin().get('_commits', 3), None)
+        
+        t2 = self.db.begin()
+        t2.put('people', 1, 'Fred')
+        t2.commit()
+        
+        # the retry still sees t2's change
+        t1._write = write
+        self.assertRaises(database.RepriseDBIntegrityError, t1.commit)
+        self.assertEqual(self.db.begin().get('people', 1), 'Fred')
+        
+    def test_concurrent_commits(self):
+        self.load_data('people', {}, value_packer='p_string')
+        
+        def worker(n):
+            for x in range(20):
+                t = self.db.begin()
+                t.put('people', n * 100 + x, 'Person %d' % x)
+                t.commit()
+        
+        threads = [ threading.Thread(target=worker, args=(n, )) for n in range(8) ]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        
+        self.assertEqual(self.db.current_commit(), 162)
+        
+        t = self.db.begin()
+        self.assertEqual(t.count('people'), 160)
+        self.assertEqual(sorted( t.get('_commits', c)['updates']['people'][0] for c in range(3, 163) ),
+                         sorted( n * 100 + x for n in range(8) for x in range(20) ))
+        
+    def test_concurrent_reads(self):
+        self.load_data('counters', {1: {'n': 0}, 2: {'n': 0}})
+        errors = []
+        
+        def writer():
+            for n in range(1, 30):
+                t = self.db.begin()
+                t.put('counters', 1, {'n': n})
+                t.put('counters', 2, {'n': n})
+                t.commit()
+        
+        def reader():
+            for _i in range(200):
+                t = self.db.begin()
+                a, b = t.get('counters', 1), t.get('counters', 2)
+                if a != b: errors.append((t.current_commit, a, b))
+        
+        threads = [ threading.Thread(target=reader) for _i in range(4) ] + [ threading.Thread(target=writer) ]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        
+        self.assertEqual(errors, [])
+        self.assertEqual(self.db.begin().get('counters', 1), {'n': 29})
+        
+    def run_process(self, target, *args):
+        p = multiprocessing.Process(target=target, args=(self.TESTDIR, ) + args)
+        p.start()
+        return p
+        
+    def test_multiple_processes(self):
+        self.load_data('people', {}, value_packer='p_string')
+        
+        processes = [ self.run_process(_commit_worker, n, 10) for n in range(4) ]
+        for p in processes:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+        
+        # picked up by our handle
+        self.assertEqual(self.db.current_commit(), 42)
+        
+        t = self.db.begin()
+        self.assertEqual(t.count('people'), 40)
+        self.assertEqual(sorted( t.get('_commits', c)['updates']['people'][0] for c in range(3, 43) ),
+                         sorted( n * 100 + x for n in range(4) for x in range(10) ))
+        
+        t.put('people', 1000, 'Local')
+        self.assertEqual(t.commit(), 43)
+        
+    def test_multiple_processes_meta(self):
+        self.load_data('people', {1: {'name': 'Bob'}})
+        self.assertEqual(self.db.begin().get_collection('people').meta['indexes'], {})
+        
+        p = self.run_process(_index_worker)
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+        
+        t = self.db.begin()
+        self.assertEqual(t.get_collection('people').meta['indexes'].keys(), ['name'])
+        self.assertEqual(t.lookup('people', 'name', 'Bob'), [1])
+        
+class LMDBBuffersDatabaseTestCase(LMDBDatabaseTestCase):
+    
+    def setUp(self):
+        self.db = database.RepriseDB(path=self.TESTDIR, driver=drivers.LMDBDriver, buffers=True)
+        
+class LMDBValueCacheDatabaseTestCase(LMDBDatabaseTestCase):
+    
+    def setUp(self):
+        self.db = database.RepriseDB(path=self.TESTDIR, driver=drivers.LMDBDriver, value_cache=100)
+        
+    def test_value_cache(self):
+        self.load_data('people', {1: {'name': 'Bob'}, 2: {'name': 'Fred'}})
+        
+        for _i in range(3):
+            self.assertEqual(self.db.begin().get('people', 1), {'name': 'Bob'})
+        self.assertEqual(self.db.value_cache.hits, 2)
+        
+        t = self.db.begin()
+        t.put('people', 1, {'name': 'Robert'})
+        t.commit()
+        
+        self.assertEqual(self.db.begin().get('people', 1), {'name': 'Robert'})
+        self.assertEqual(self.db.begin(t.current_commit - 1).get('people', 1), {'name': 'Bob'})
+        
+    def test_value_cache_modify(self):
+        self.load_data('people', {1: {'name': 'Bob'}})
+        self.assertEqual(self.db.begin().get('people', 1), {'name': 'Bob'})
+        
+        # read, modify and write back a cached value
+        t = self.db.begin()
+        item = t.get('people', 1)
+        item['name'] = 'Fred'
+        self.assertEqual(t.get('people', 1), {'name': 'Bob'})
+        self.assertTrue(t.put('people', 1, item))
+        t.commit()
+        
+        self.assertEqual(self.db.begin().get('people', 1), {'name': 'Fred'})
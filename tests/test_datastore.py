@@ -1,8 +1,9 @@
 from . import RepriseDBTestCase
 
-from reprisedb import drivers, datastore
+from reprisedb import drivers, datastore, packers, utils, DELETED
 
 import logging
+import os.path
 
 class BaseDataStoreTestCase(RepriseDBTestCase):
     
@@ -80,6 +81,16 @@ class RevisionDataStoreTestCase(BaseDataStoreTestCase):
         self.assertEqual(f(start_key='c\x00', end_key='f\x00', end_revision=2), ['C', 'D', 'E'])
         self.assertEqual(f(start_key='c\x00', end_key='f\x00', start_revision=2), ['CHARLIE', 'DELTA'])
         
+    def test_iter_items_long_history(self):
+        for r in xrange(4, 14):
+            self.ds.store([('c\x00', 'C%d' % r)], r)
+        
+        for step, run in ((False, 0), (True, 0), (True, 1), (True, 8)):
+            self.ds.step_keys, self.ds.seek_run = step, run
+            self.assertEqual(self.iter_items(), ['A', 'B', 'C13', 'DELTA', 'E', 'F'])
+            self.assertEqual(self.iter_items(end_revision=8), ['A', 'B', 'C8', 'DELTA', 'E', 'F'])
+            self.assertEqual(self.iter_items(start_revision=3, end_revision=8), ['C8', 'DELTA'])
+        
     def test_get_item(self):
         
         def f(**kwargs):
@@ -134,7 +145,119 @@ class RevisionDataStoreTestCase(BaseDataStoreTestCase):
         self.assertEqual([ x[2] for x in self.ds.iter_prune(3) ], ['A4', 'A', 'CHARLIE', 'C'])
         self.assertEqual([ x[2] for x in self.ds.iter_prune(2) ], ['A5', 'B', 'C5'])
         
+        self.assertEqual([ x[2] for x in self.ds.iter_prune(1, 'b\x00', 'c\x00') ], ['B4'])
+        
+    def test_prune(self):
+        for r in range(4, 8):
+            self.ds.store([ (k, '%s%d' % (k[0].upper(), r)) for k in ('a\x00', 'b\x00', 'c\x00') ], r)
+            
+        self.assertEqual(list(self.ds.iter_keys()), ['a\x00', 'b\x00', 'c\x00', 'd\x00', 'e\x00', 'f\x00'])
+        self.assertEqual(self.ds.prune(2, batch_size=2), 10)
+        self.assertEqual([ x[2] for x in self.ds.iter_revisions() ],
+                         ['A7', 'A6', 'B7', 'B6', 'C7', 'C6', 'DELTA', 'D', 'E', 'F'])
+        
+    def test_vacuum(self):
+        self.ds.store([('a\x00', DELETED), ('b\x00', 'B4'), ('e\x00', DELETED)], 4)
+        self.ds.store([('a\x00', 'A6'), ('b\x00', DELETED)], 6)
+        
+        def visible():
+            return [ [ v for v in self.iter_items(end_revision=r) if v != DELETED ] for r in (4, 5, 6) ]
+        before = visible()
+        
+        self.assertEqual(self.ds.vacuum(4, batch_size=2), 7)
+        self.assertEqual([ x[2] for x in self.ds.iter_revisions() ],
+                         ['A6', DELETED, 'B4', 'CHARLIE', 'DELTA', 'F'])
+        
+        # reads from before_revision on are unchanged
+        self.assertEqual(visible(), before)
+        
+    def test_store_append(self):
+        # after all existing keys
+        self.ds.store([('g\x00', 'G'),
+                       ('h\x00', 'H')], 4, append=True)
+        # falls back to normal writes
+        self.ds.store([('a\x00', 'A5'),
+                       ('i\x00', 'I')], 5, append=True)
+        
+        # not actually sorted
+        self.ds.store([('j\x00', 'J'),
+                       ('l\x00', 'L'),
+                       ('k\x00', 'K')], 6, append=True)
+        
+        self.assertEqual(self.iter_items(), ['A5', 'B', 'CHARLIE', 'DELTA', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L'])
+        self.assertEqual(self.iter_items(end_revision=4), ['A', 'B', 'CHARLIE', 'DELTA', 'E', 'F', 'G', 'H'])
 
+class BuffersRevisionDataStoreTestCase(RevisionDataStoreTestCase):
+    
+    def get_datastore(self):
+        driver = drivers.LMDBDriver(self.TESTDIR)
+        return datastore.RevisionDataStore(driver.get_db('testing'), 0, buffers=True)
+    
+    def iter_items(self, **kwargs):
+        # buffers are only valid while iterating
+        return [ str(x[2]) for x in self.ds.iter_items(**kwargs) ]
+    
+    def test_buffers(self):
+        self.assertEqual(set( type(x[2]) for x in self.ds.iter_items() ), set([buffer]))
+        self.assertEqual(type(self.ds.get_item('a\x00')[1]), str)
+
+class CachedRevisionDataStoreTestCase(RevisionDataStoreTestCase):
+    
+    def get_datastore(self):
+        driver = drivers.LMDBDriver(self.TESTDIR)
+        return datastore.RevisionDataStore(driver.get_db('testing'), 0, cache=utils.ValueCache(4))
+    
+    def test_get_value(self):
+        cache = self.ds.cache
+        
+        self.assertEqual(self.ds.get_value('c\x00', str.lower, 3)[1], 'charlie')
+        # miss but the same revision so extends the entry
+        self.assertEqual(self.ds.get_value('c\x00', str.lower, 5)[1], 'charlie')
+        self.assertEqual(self.ds.get_value('c\x00', str.lower, 4)[1], 'charlie')
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        
+        # newer revision closes the entry
+        self.ds.store([('c\x00', 'C5'),
+                       ('d\x00', DELETED)], 5)
+        self.assertEqual(self.ds.get_value('c\x00', str.lower, 4)[1], 'charlie')
+        self.assertEqual(self.ds.get_value('c\x00', str.lower, 5)[1], 'c5')
+        self.assertEqual(self.ds.get_value('d\x00', str.lower, 5)[1], None)
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+        
+        self.assertRaises(KeyError, self.ds.get_value, 'z\x00', str.lower, 5)
+        
+        for k in 'abef':
+            self.ds.get_value(k + '\x00', str.lower, 5)
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(cache.peek((self.ds.env, 'c\x00')), None)
+        
+class SnapshotDataStoreTestCase(BaseDataStoreTestCase):
+    
+    def get_datastore(self):
+        self.driver = drivers.LMDBDriver(self.TESTDIR)
+        return datastore.RevisionDataStore(self.driver.get_db('testing'), 0)
+    
+    def test_snapshot(self):
+        snapshot = self.driver.snapshot()
+        ds = self.ds.with_snapshot(snapshot)
+        
+        self.ds.store([('a\x00', 'A4'),
+                       ('g\x00', 'G4')], 4)
+        
+        # snapshot doesn't see the new revision
+        self.assertEqual(ds.get_item('a\x00')[1], 'A')
+        self.assertEqual([ x[2] for x in ds.iter_items() ], ['A', 'B', 'CHARLIE', 'DELTA', 'E', 'F'])
+        self.assertEqual(self.ds.get_item('a\x00')[1], 'A4')
+        
+        # point reads share a cursor with an open range read
+        result = []
+        for k, _r, v in ds.iter_items():
+            result.append((v, ds.get_item('a\x00')[1]))
+        self.assertEqual(result[-1], ('F', 'A'))
+        self.assertEqual(len(result), 6)
+        
+        snapshot.close()
+        
 class MemoryDataStoreTestCase(BaseDataStoreTestCase):
     
     def get_datastore(self):
@@ -158,12 +281,154 @@ class MemoryDataStoreTestCase(BaseDataStoreTestCase):
         
         self.assertEqual(f(['a\x00', 'g\x00']), ['A', None])
         
+class BufferDataStoreTestCase(MemoryDataStoreTestCase):
+    
+    def get_datastore(self):
+        driver = drivers.LMDBDriver(self.TESTDIR)
+        return datastore.BufferDataStore(driver, 10)
+    
+    def tearDown(self):
+        self.ds.close()
+        super(BufferDataStoreTestCase, self).tearDown()
+    
+    def test_spill(self):
+        self.assertEqual(len(self.ds.memory), 0)
+        
+        self.ds.store([('g\x00', 'G')])
+        self.assertEqual(len(self.ds.memory), 1)
+        
+        self.assertEqual(list(self.ds.iteritems()), [('a\x00', 'A'), ('b\x00', 'B'), ('c\x00', 'CHARLIE'),
+                                                     ('d\x00', 'DELTA'), ('e\x00', 'E'), ('f\x00', 'F'),
+                                                     ('g\x00', 'G')])
+        
+        path = self.ds.scratch.env._path
+        self.ds.close()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(list(self.ds.iteritems()), [])
+        
+    def test_spill_dropped(self):
+        self.ds.store([('g\x00', 'G')])
+        path = self.ds.scratch.env._path
+        
+        # never closed
+        self.ds = datastore.BufferDataStore(self.ds.driver, 10)
+        self.assertFalse(os.path.exists(path))
+        
+    def test_no_scratch(self):
+        self.ds.close()
+        self.ds = datastore.BufferDataStore(drivers.BaseDriver(self.TESTDIR), 10)
+        self.ds.store([('g\x00', 'G'), ('h\x00', 'H')])
+        
+        self.assertEqual(self.ds.scratch, None)
+        self.assertEqual(list(self.ds.iteritems()), [('g\x00', 'G'), ('h\x00', 'H')])
+        
 class ArchiveDataStoreTestCase(RevisionDataStoreTestCase):
     
     def get_datastore(self):
         driver = drivers.LMDBDriver(self.TESTDIR)
         return datastore.ArchiveDataStore(driver.get_db('testing'), self.TESTDIR + "/testing-archive" , 0)
     
+class BlockArchiveDataStoreTestCase(RevisionDataStoreTestCase):
+    
+    def get_datastore(self):
+        driver = drivers.LMDBDriver(self.TESTDIR)
+        return datastore.ArchiveDataStore(driver.get_db('testing'), self.TESTDIR + "/testing-archive", 0, block_size=8)
+    
+    def test_blocks(self):
+        self.ds.store([ ('z%02d\x00' % i, 'Zulu' * i) for i in range(20) ], 12)
+        self.assertEqual(self.ds.get_item('z07\x00')[1], 'Zulu' * 7)
+        
+        self.assertEqual([ v for _k, _r, v in self.ds.iter_items('z', 'z99') ],
+                         [ 'Zulu' * i for i in range(20) ])
+        
+        # small values are grouped into the same block
+        locations = [ self.ds.location_packer.unpack(v)[0] 
+                      for _k, _r, v in super(datastore.ArchiveDataStore, self.ds).iter_items('z', 'z99') ]
+        self.assertEqual(len(set(locations)), 18)
+    
+class CompactTestCase(RepriseDBTestCase):
+    
+    def setUp(self):
+        driver = drivers.LMDBDriver(self.TESTDIR)
+        self.source = datastore.RevisionDataStore(driver.get_db('source'), 0)
+        for r in range(1, 6):
+            self.source.store([ ('%03d\x00' % k, 'V%d-%d' % (k, r)) for k in range(100) ], r)
+        self.archive = datastore.ArchiveDataStore(driver.get_db('archive'), self.TESTDIR + '/archive', 0, block_size=256, index_blocks=3)
+        
+    def tearDown(self):
+        self.archive.close()
+        super(CompactTestCase, self).tearDown()
+        
+    def check(self, processes):
+        expected = list(self.source.iter_revisions())
+        
+        self.assertEqual(datastore.compact(self.source, self.archive, keep=3, processes=processes, batch_size=7), 200)
+        self.assertEqual(list(self.archive.iter_revisions()), expected)
+        self.assertEqual([ v for _k, _r, v in self.source.iter_revisions() if v.startswith('V42-') ], ['V42-5', 'V42-4', 'V42-3'])
+        
+    def test_compact(self):
+        self.check(None)
+        
+    def test_compact_processes(self):
+        self.check(2)
+        
+class ArchiveProxyDataStoreTestCase(RepriseDBTestCase):
+    
+    def setUp(self):
+        driver = drivers.LMDBDriver(self.TESTDIR)
+        self.archives = []
+        for n in range(3):
+            ds = datastore.ArchiveDataStore(driver.get_db('archive-%d' % n), '%s/archive-%d' % (self.TESTDIR, n), 0)
+            ds.store([ ('%02d\x00' % k, 'V%d' % k) for k in range(n, 30, 3) ], n + 1)
+            self.archives.insert(0, ds)
+        self.ds = datastore.ProxyDataStore(self.archives)
+        
+    def tearDown(self):
+        for ds in self.archives:
+            ds.close()
+        super(ArchiveProxyDataStoreTestCase, self).tearDown()
+        
+    def test_bloom(self):
+        self.assertTrue(os.path.exists(self.TESTDIR + '/archive-0.bloom'))
+        
+        for k in range(30):
+            self.assertTrue(self.archives[2 - k % 3].might_contain('%02d\x00' % k))
+        
+        # reloaded from disk
+        ds = datastore.ArchiveDataStore(self.archives[0].env, self.TESTDIR + '/archive-2', 0)
+        self.assertTrue(ds.might_contain('02\x00'))
+        self.assertFalse(ds.might_contain('zz\x00'))
+        
+    def test_bloom_updates(self):
+        ds = self.archives[0]
+        rebuilds = []
+        build_bloom = ds.build_bloom
+        ds.build_bloom = lambda: rebuilds.append(ds.bloom) or build_bloom()
+        
+        # new keys are added without rereading the archive
+        for n in range(5):
+            ds.store([('x%02d\x00' % n, 'X')], 10 + n)
+        self.assertEqual(rebuilds, [])
+        self.assertEqual(ds.bloom.count, 15)
+        self.assertTrue(ds.might_contain('x04\x00'))
+        self.assertEqual(utils.BloomFilter.load(self.TESTDIR + '/archive-2.bloom').count, 15)
+        
+        # until it is full
+        ds.bloom.capacity = 15
+        ds.store([('y\x00', 'Y')], 20)
+        self.assertEqual(rebuilds, [None])
+        self.assertEqual((ds.bloom.count, ds.bloom.capacity), (16, 1024))
+        self.assertTrue(ds.might_contain('y\x00'))
+        
+    def test_get_item(self):
+        self.assertEqual(self.ds.get_item('04\x00'), (packers.p_revision.pack(2), 'V4'))
+        self.assertRaises(KeyError, self.ds.get_item, '99\x00')
+        
+    def test_iter_get(self):
+        keys = [ '%02d\x00' % k for k in range(32) ]
+        self.assertEqual([ v for _k, _r, v in self.ds.iter_get(keys, batch_size=7) ],
+                         [ 'V%d' % k for k in range(30) ] + [None, None])
+        
 class ProxyDataStoreTestCase(MemoryDataStoreTestCase):
         
     def setUp(self):
@@ -180,4 +445,12 @@ class ProxyDataStoreTestCase(MemoryDataStoreTestCase):
                         ('d\x00', 'DELTA')], 3)
         self.ds = datastore.ProxyDataStore([self.ds3, self.ds2, self.ds1])
         
-            
\ No newline at end of file
+            
+        
+    def test_iter_get_batches(self):
+        keys = [ '%s\x00' % x for x in 'abcdefg' ]
+        self.assertEqual([ x[2] for x in self.ds.iter_get(keys, batch_size=2) ],
+                         ['A', 'B', 'CHARLIE', 'DELTA', 'E', 'F', None])
+        
+        revisions = [ packers.p_revision.pack(x) for x in [1, 2, 3, 3, 1, 2] ] + [None]
+        self.assertEqual([ x[1] for x in self.ds.iter_get(keys, batch_size=3) ], revisions)
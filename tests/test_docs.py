@@ -1,7 +1,9 @@
 import doctest
-from reprisedb import packers, entries
+from reprisedb import packers, entries, database, query
 
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(packers))
     tests.addTests(doctest.DocTestSuite(entries))
+    tests.addTests(doctest.DocTestSuite(database))
+    tests.addTests(doctest.DocTestSuite(query))
     return tests
\ No newline at end of file
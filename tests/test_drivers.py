@@ -1,3 +1,4 @@
+from unittest import skipUnless
 
 from reprisedb import drivers, datastore
 
@@ -9,6 +10,19 @@ class BSDDBDriverTestCase(RevisionDataStoreTestCase):
         driver = drivers.BSDDBDriver(self.TESTDIR)
         return datastore.RevisionDataStore(driver.get_db('testing'), 0)
     
+    @skipUnless(drivers.HAS_BSDDB, "bsddb is not installed")
+    def test_putmulti(self):
+        with self.ds.env.begin(write=True) as txn:
+            with txn.cursor() as c:
+                self.assertEqual(c.putmulti(iter([('y\x00', 'Y'), ('x\x00', 'X')]), append=True), (2, 2))
+        
+        # out of order keys in an appending store
+        self.ds.store([('m\x00', 'M'),
+                       ('n\x00', 'N'),
+                       ('l\x00', 'L')], 4, append=True)
+        self.assertEqual(self.ds.get_item('l\x00')[1], 'L')
+        self.assertEqual(self.ds.get_item('n\x00')[1], 'N')
+    
 class LMDBDriverTestCase(RevisionDataStoreTestCase):
     
     def get_datastore(self):